@@ -1,9 +1,10 @@
-from dataclasses import asdict
+import hashlib
+from dataclasses import fields
 
-from flask import request, jsonify, Response, Flask
+from flask import request, jsonify, Response, Flask, send_file
 from flask.json.provider import DefaultJSONProvider
 
-from common import VIXEN_DIR
+from common import VIXEN_DIR, SongsDescriptor, InfoDescriptor
 from pylightscontroller import PylightsController
 
 
@@ -12,7 +13,8 @@ from pylightscontroller import PylightsController
 class CustomJSONProvider(DefaultJSONProvider):
     def default(self, obj):
         if hasattr(obj, '__dataclass_fields__'):
-            return asdict(obj)
+            # shallow, nested dataclasses come back through default() (asdict would deep-copy everything)
+            return {f.name: getattr(obj, f.name) for f in fields(obj)}
         return super().default(obj)
 
 
@@ -21,6 +23,41 @@ app.json = CustomJSONProvider(app)
 
 controller = PylightsController(VIXEN_DIR)
 
+_catalog_json_cache: dict[int, str] = {}
+
+
+def _catalog_json(descriptor: SongsDescriptor) -> str:
+    # the songs list only changes on rescan, so it is serialized once per catalog version
+    if descriptor.catalog_version not in _catalog_json_cache:
+        _catalog_json_cache.clear()
+        _catalog_json_cache[descriptor.catalog_version] = app.json.dumps(descriptor.songs)
+    return _catalog_json_cache[descriptor.catalog_version]
+
+
+def _json_without_songs(descriptor: SongsDescriptor | InfoDescriptor) -> str:
+    return app.json.dumps({f.name: getattr(descriptor, f.name) for f in fields(descriptor) if f.name != 'songs'})
+
+
+def _versioned_jsonify(descriptor: SongsDescriptor | InfoDescriptor) -> tuple[Response, int]:
+    # only the small dynamic part (position, volume, lights...) is serialized on every request, the cached songs
+    # list is spliced in, and clients polling with If-None-Match get a 304 while nothing has changed
+    songs = descriptor if isinstance(descriptor, SongsDescriptor) else descriptor.songs
+    songs_dynamic_json = _json_without_songs(songs)
+    info_dynamic_json = _json_without_songs(descriptor) if descriptor is not songs else ''
+
+    etag = hashlib.sha1(f'{songs.catalog_version}:{songs_dynamic_json}:{info_dynamic_json}'.encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        body = f'{{"songs": {_catalog_json(songs)}, {songs_dynamic_json[1:]}'
+        if info_dynamic_json:
+            body = f'{{"songs": {body}, {info_dynamic_json[1:]}'
+        response = app.response_class(body, mimetype='application/json')
+
+    response.set_etag(etag)
+    return response, response.status_code
+
+
 # ------------------------------------------------------------------------------------------------
 
 
@@ -28,6 +65,10 @@ controller = PylightsController(VIXEN_DIR)
 
 BASE_ENDPOINT = '/pylights-api'
 
+# a request carrying the album art hash (album_art_hash in the song descriptor) names one exact image, so clients may
+# keep that response for good; without the hash the URL stays the same when the image changes, so it is revalidated
+ALBUM_ART_MAX_AGE_S = 365 * 24 * 60 * 60
+
 
 @app.route(f'{BASE_ENDPOINT}/songs/play')
 def songs_play() -> tuple[Response, int]:
@@ -37,25 +78,25 @@ def songs_play() -> tuple[Response, int]:
         return jsonify({'error': 'The "name" query parameter is required.'}), 400
 
     descriptor = controller.songs.play(name)
-    return jsonify(descriptor), 200
+    return _versioned_jsonify(descriptor)
 
 
 @app.route(f'{BASE_ENDPOINT}/songs/pause')
 def songs_pause() -> tuple[Response, int]:
     descriptor = controller.songs.pause()
-    return jsonify(descriptor), 200
+    return _versioned_jsonify(descriptor)
 
 
 @app.route(f'{BASE_ENDPOINT}/songs/resume')
 def songs_resume() -> tuple[Response, int]:
     descriptor = controller.songs.resume()
-    return jsonify(descriptor), 200
+    return _versioned_jsonify(descriptor)
 
 
 @app.route(f'{BASE_ENDPOINT}/songs/stop')
 def songs_stop() -> tuple[Response, int]:
     descriptor = controller.songs.stop()
-    return jsonify(descriptor), 200
+    return _versioned_jsonify(descriptor)
 
 
 @app.route(f'{BASE_ENDPOINT}/songs/volume')
@@ -69,7 +110,69 @@ def songs_volume() -> tuple[Response, int]:
 
     controller.songs.volume = volume
     descriptor = controller.songs.get_info()
-    return jsonify(descriptor), 200
+    return _versioned_jsonify(descriptor)
+
+
+@app.route(f'{BASE_ENDPOINT}/songs/queue')
+def songs_queue() -> tuple[Response, int]:
+    descriptor = controller.songs.get_info()
+    return _versioned_jsonify(descriptor)
+
+
+@app.route(f'{BASE_ENDPOINT}/songs/queue/add')
+def songs_queue_add() -> tuple[Response, int]:
+    name = request.args.get('name')
+
+    if not name:
+        return jsonify({'error': 'The "name" query parameter is required.'}), 400
+    if name not in controller.songs.songs:
+        return jsonify({'error': f'Song not found: {name}'}), 404
+
+    descriptor = controller.songs.queue_add(name)
+    return _versioned_jsonify(descriptor)
+
+
+@app.route(f'{BASE_ENDPOINT}/songs/queue/remove')
+def songs_queue_remove() -> tuple[Response, int]:
+    index = request.args.get('index', type=int)
+
+    if index is None:
+        return jsonify({'error': 'The "index" query parameter is required.'}), 400
+
+    descriptor = controller.songs.queue_remove(index)
+    return _versioned_jsonify(descriptor)
+
+
+@app.route(f'{BASE_ENDPOINT}/songs/queue/clear')
+def songs_queue_clear() -> tuple[Response, int]:
+    descriptor = controller.songs.queue_clear()
+    return _versioned_jsonify(descriptor)
+
+
+@app.route(f'{BASE_ENDPOINT}/songs/album-art')
+def songs_album_art() -> Response | tuple[Response, int]:
+    name = request.args.get('name')
+
+    if not name:
+        return jsonify({'error': 'The "name" query parameter is required.'}), 400
+
+    album_art = controller.songs.get_album_art(name)
+    if album_art is None:
+        return jsonify({'error': f'No album art found for song: {name}'}), 404
+
+    # conditional=True answers a matching If-None-Match with 304 Not Modified
+    image_file, image_hash = album_art
+    versioned = request.args.get('hash') == image_hash
+    response = send_file(
+        image_file.absolute(),
+        mimetype='image/jpeg',
+        etag=image_hash,
+        max_age=ALBUM_ART_MAX_AGE_S if versioned else None,  # None sends no-cache
+        conditional=True
+    )
+    if versioned:
+        response.cache_control.immutable = True
+    return response
 
 
 @app.route(f'{BASE_ENDPOINT}/lights/all-on')
@@ -167,7 +270,9 @@ def remap_cancel() -> tuple[Response, int]:
 
 @app.route(f'{BASE_ENDPOINT}/developer/recompile-shows')
 def developer_recompile_shows() -> tuple[Response, int]:
-    descriptor = controller.developer.recompile_shows()
+    force = request.args.get('force', default=False, type=lambda x: x.lower() in ('1', 'true'))
+
+    descriptor = controller.developer.recompile_shows(force)
     return jsonify(descriptor), 200
 
 
@@ -180,7 +285,7 @@ def developer_info() -> tuple[Response, int]:
 @app.route(f'{BASE_ENDPOINT}/info')
 def info() -> tuple[Response, int]:
     descriptor = controller.get_info()
-    return jsonify(descriptor), 200
+    return _versioned_jsonify(descriptor)
 
 
 # ------------------------------------------------------------------------------------------------
@@ -1,7 +1,11 @@
+import hashlib
+import os
 import socket
 from dataclasses import dataclass, field
 from pathlib import Path
 
+import numpy as np
+
 # ---- Constants ---------------------------------------------------------------------------------
 
 VERSION = '1.0'
@@ -17,13 +21,23 @@ NUM_BYTES_TOTAL = NUM_BYTES_RELAYS + NUM_BYTES_L + NUM_BYTES_R
 VIXEN_DIR = Path('Vixen 3')
 DEBUG_VIXEN_SAMPLE_FSEQ_PATH = Path('Vixen 3/Export/Carey Grinch.fseq')
 
-try:
-    ZERO_IP = socket.gethostbyname('pylightszero.local')
-except socket.gaierror:
-    print('Debugging mode active; pylightszero control disabled')
-    ZERO_IP = ''
+# PYLIGHTS_LED_SERVER_STUB=1 runs led_server_stub.py on this machine in place of led_server on the pi zero
+LED_SERVER_STUB = os.environ.get('PYLIGHTS_LED_SERVER_STUB') == '1'
+
+if LED_SERVER_STUB:
+    print('Stub mode active; led_server_stub.py replaces pylightszero')
+    ZERO_IP = '127.0.0.1'
+else:
+    try:
+        ZERO_IP = socket.gethostbyname('pylightszero.local')
+    except socket.gaierror:
+        print('Debugging mode active; pylightszero control disabled')
+        ZERO_IP = ''
 ZERO_PORT = 12345
 
+# local UDP port the mock gpiozero backend pushes LED state deltas to, for led_gui.py
+LED_GUI_PORT = 12346
+
 
 # ------------------------------------------------------------------------------------------------
 
@@ -37,7 +51,8 @@ class Song:
     mp3_file: Path
     fseq_file: Path
     artist: str
-    album_art: str
+    album_art_file: Path | None
+    album_art_hash: str  # sha256 of the album art, '' if there is none
     length_ms: float
 
     @property
@@ -48,11 +63,11 @@ class Song:
 
 @dataclass
 class FSEQFrame:
-    raw_bytes: bytes
+    raw_bytes: bytes | memoryview
 
-    relay_bytes: bytes = field(init=False)
-    light_strip_l_bytes: bytes = field(init=False)
-    light_strip_r_bytes: bytes = field(init=False)
+    relay_bytes: memoryview = field(init=False)
+    light_strip_l_bytes: memoryview = field(init=False)
+    light_strip_r_bytes: memoryview = field(init=False)
 
     def __post_init__(self):
         # relay_bytes         = 16 relays x 1 byte/relay = 16 bytes
@@ -61,26 +76,50 @@ class FSEQFrame:
         #                                                = 3367 bytes total
         assert len(self.raw_bytes) == NUM_BYTES_TOTAL
 
-        self.relay_bytes = self.raw_bytes[:NUM_BYTES_RELAYS]
-        self.light_strip_l_bytes = self.raw_bytes[NUM_BYTES_RELAYS:NUM_BYTES_RELAYS + NUM_BYTES_L]
-        self.light_strip_r_bytes = self.raw_bytes[NUM_BYTES_RELAYS + NUM_BYTES_L:]
+        # slice through a memoryview so the strips share the frame's buffer instead of being copied
+        raw = memoryview(self.raw_bytes)
+        self.relay_bytes = raw[:NUM_BYTES_RELAYS]
+        self.light_strip_l_bytes = raw[NUM_BYTES_RELAYS:NUM_BYTES_RELAYS + NUM_BYTES_L]
+        self.light_strip_r_bytes = raw[NUM_BYTES_RELAYS + NUM_BYTES_L:]
+
+
+@dataclass
+class FSEQFrameMatrix:
+    frames: np.ndarray  # uint8, shape (number of frames, NUM_BYTES_TOTAL)
+
+    relays: np.ndarray = field(init=False)
+    light_strip_l: np.ndarray = field(init=False)
+    light_strip_r: np.ndarray = field(init=False)
+
+    def __post_init__(self):
+        assert self.frames.ndim == 2 and self.frames.shape[1] == NUM_BYTES_TOTAL
+
+        # column slices are views, so the named parts share memory with the frames
+        self.relays = self.frames[:, :NUM_BYTES_RELAYS]
+        self.light_strip_l = self.frames[:, NUM_BYTES_RELAYS:NUM_BYTES_RELAYS + NUM_BYTES_L]
+        self.light_strip_r = self.frames[:, NUM_BYTES_RELAYS + NUM_BYTES_L:]
+
+    def __len__(self) -> int:
+        return len(self.frames)
 
 
 @dataclass
 class SongDescriptor:
     title: str
     artist: str
-    album_art: str
+    album_art_hash: str  # the image itself is served by /songs/album-art, '' if there is none
     length_ms: float
 
 
 @dataclass
 class SongsDescriptor:
     songs: list[SongDescriptor]
+    catalog_version: int  # changes only when a rescan changes the songs list
     playing: SongDescriptor | None
     paused: bool
     current_time_ms: float
     volume: int  # 0-100
+    queue: list[str]  # titles of the songs to play after the current one, in order
 
 
 @dataclass
@@ -111,6 +150,19 @@ class RemapDescriptor:
     remaining: list[str] | None
 
 
+@dataclass
+class PlaybackDescriptor:
+    wakeups: int
+    mean_jitter_ms: float  # how late the relay thread woke up compared to its frame deadline
+    max_jitter_ms: float
+    cpu_percent: float  # cpu time used by the relay thread relative to how long it has been running
+    start_latency_ms: float | None  # from the play request until the audio started, for the last song
+    start_skew_ms: float | None  # how far the audio start missed the moment planned with led_server
+    sync_offset_ms: float | None  # how far the LED strips were ahead of the audio at the last position sync
+    max_sync_offset_ms: float
+    sync_offset_history_ms: list[float]  # one per position sync, most recent last
+
+
 @dataclass
 class DeveloperDescriptor:
     version: str
@@ -118,6 +170,8 @@ class DeveloperDescriptor:
     cpu_usage: float
     led_server_ip_address: str
     led_server_status: bool
+    led_server_rtt_ms: float | None  # round trip time of the last command acknowledged by led_server
+    playback: PlaybackDescriptor
 
 
 @dataclass
@@ -139,4 +193,12 @@ def print_progress(message: str) -> None:
 def print_done() -> None:
     print('Done')
 
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with path.open('rb') as f:
+        while chunk := f.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
 # ------------------------------------------------------------------------------------------------
@@ -1,9 +1,14 @@
+import mmap
+from bisect import bisect_right
+from collections import OrderedDict
 from pathlib import Path
+from threading import Event, Lock, Thread
 from typing import Generator
 
+import numpy as np
 import zstandard as zstd
 
-from common import FSEQFrame, DEBUG_VIXEN_SAMPLE_FSEQ_PATH
+from common import FSEQFrame, FSEQFrameMatrix, DEBUG_VIXEN_SAMPLE_FSEQ_PATH
 
 
 class ParserError(Exception):
@@ -25,8 +30,14 @@ def compression_type_from_num(n: int) -> str:
 
 
 class FSEQParser:
-    def __init__(self, fseq_file: Path):
+    # number of decompressed blocks kept around, so scrubbing back and forth doesn't decompress again
+    BLOCK_CACHE_SIZE = 4
+    # number of frames decompressed per read when streaming through the whole sequence
+    STREAM_BATCH_FRAMES = 64
+
+    def __init__(self, fseq_file: Path, prefetch: bool = False, use_mmap: bool = True):
         self.file = fseq_file.open('rb')
+        self.file_lock = Lock()
 
         magic = self.file.read(4)
         if magic != b'PSEQ':
@@ -79,6 +90,9 @@ class FSEQParser:
                 offset += length_of_block
         self.frame_offsets.append((self.number_of_frames, offset))
 
+        # first frame of every block, sorted, so the block holding a frame can be found with a binary search
+        self.block_start_frames = [frame_number for frame_number, _ in self.frame_offsets]
+
         sparse_ranges = []
         for i in range(num_sparse_ranges):
             start_channel_number = int_from_bytes(self.file.read(3))
@@ -101,44 +115,210 @@ class FSEQParser:
 
         self.song_length_ms = self.number_of_frames * self.step_time_in_ms
 
+        # decompressed block cache (block index -> block bytes), ordered from least to most recently used
+        self.prefetch = prefetch
+        self.decompressor = zstd.ZstdDecompressor()
+        self.decompressor_lock = Lock()
+        self.block_cache: OrderedDict[int, bytes] = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # blocks a prefetch thread is decompressing right now, each with an event set once it is cached
+        self.prefetching: dict[int, Event] = {}
+
+        # uncompressed channel data can be sliced straight out of a read-only mapping of the file
+        self.mmap: mmap.mmap | None = None
+        self.mmap_view: memoryview | None = None
+        if self.compression_type == 'none' and use_mmap:
+            self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.mmap_view = memoryview(self.mmap)
+
     def __del__(self):
         try:
-            self.file.close()
+            self.close()
         except AttributeError:
             pass  # the file was never opened because of FileNotFoundError
 
+    def close(self) -> None:
+        if getattr(self, 'mmap', None) is not None:
+            self.mmap_view.release()
+            try:
+                self.mmap.close()
+            except BufferError:
+                pass  # frames handed out still reference the mapping, it is unmapped once they are gone
+            self.mmap = None
+            self.mmap_view = None
+        self.file.close()
+
     def get_frame_at_index(self, frame_index: int) -> FSEQFrame:
         if frame_index >= self.number_of_frames:
             raise ValueError('frame index out of bounds')
 
-        current_block = 0
-        while frame_index >= self.frame_offsets[current_block + 1][0]:
-            current_block += 1
-
-        offset = self.frame_offsets[current_block][1]
-        self.file.seek(offset, 0)
+        current_block = bisect_right(self.block_start_frames, frame_index) - 1
 
         if self.compression_type == 'zstd':
-            decompressor = zstd.ZstdDecompressor()
-
-            length = self.frame_offsets[current_block + 1][1] - self.frame_offsets[current_block][1]
-            block = self.file.read(length)
-            block = decompressor.stream_reader(block).readall()
-
+            block = self._get_block(current_block)
             fidx = (frame_index - self.frame_offsets[current_block][0]) * self.channel_count_per_frame
+            data = memoryview(block)[fidx:fidx + self.channel_count_per_frame]
         else:
-            block = self.file.read()
-            fidx = frame_index * self.channel_count_per_frame
+            offset = self.frame_offsets[0][1] + frame_index * self.channel_count_per_frame
+            if self.mmap_view is not None:
+                data = self.mmap_view[offset:offset + self.channel_count_per_frame]
+            else:
+                with self.file_lock:
+                    self.file.seek(offset, 0)
+                    data = self.file.read(self.channel_count_per_frame)
 
-        data = block[fidx:fidx + self.channel_count_per_frame]
         return FSEQFrame(data)
 
+    def _read_block(self, block_index: int) -> bytes:
+        offset = self.frame_offsets[block_index][1]
+        length = self.frame_offsets[block_index + 1][1] - offset
+
+        # the file position and the decompressor are shared with the prefetch thread, but under separate locks,
+        # so cache lookups (under file_lock) never wait for a decompression
+        with self.file_lock:
+            self.file.seek(offset, 0)
+            block = self.file.read(length)
+        with self.decompressor_lock:
+            return self.decompressor.stream_reader(block).readall()
+
+    def _cache_block(self, block_index: int, block: bytes) -> None:
+        with self.file_lock:
+            self.block_cache[block_index] = block
+            self.block_cache.move_to_end(block_index)
+            while len(self.block_cache) > self.BLOCK_CACHE_SIZE:
+                self.block_cache.popitem(last=False)
+
+    def _prefetch_block(self, block_index: int) -> None:
+        try:
+            self._cache_block(block_index, self._read_block(block_index))
+        finally:
+            with self.file_lock:
+                self.prefetching.pop(block_index).set()
+
+    def _start_prefetch(self, block_index: int) -> None:
+        # during sequential playback the next block is needed soon, so decompress it in the background,
+        # unless it is cached already or on its way
+        if not self.prefetch or block_index + 1 >= len(self.frame_offsets):
+            return
+        with self.file_lock:
+            if block_index in self.block_cache or block_index in self.prefetching:
+                return
+            self.prefetching[block_index] = Event()
+        Thread(target=self._prefetch_block, args=(block_index,), daemon=True).start()
+
+    def _get_block(self, block_index: int) -> bytes:
+        with self.file_lock:
+            block = self.block_cache.get(block_index)
+            if block is not None:
+                self.cache_hits += 1
+                self.block_cache.move_to_end(block_index)
+            else:
+                self.cache_misses += 1
+            in_flight = self.prefetching.get(block_index)
+
+        # the prefetch thread is already decompressing this block, so wait for it instead of doing it twice
+        if block is None and in_flight is not None:
+            in_flight.wait()
+            with self.file_lock:
+                block = self.block_cache.get(block_index)
+
+        if block is None:
+            block = self._read_block(block_index)
+            self._cache_block(block_index, block)
+
+        # on hits too, otherwise a prefetched block would never prefetch the one after it
+        self._start_prefetch(block_index + 1)
+        return block
+
     def get_frame_at_ms(self, milliseconds: int) -> FSEQFrame:
         return self.get_frame_at_index(milliseconds // self.step_time_in_ms)
 
+    def iter_frame_batches(self, batch_frames: int = STREAM_BATCH_FRAMES) -> Generator[bytes | memoryview, None, None]:
+        # yields the raw channel data of up to batch_frames consecutive frames at a time, in order,
+        # decompressing every block exactly once and never holding more than one batch in memory
+        frame_size = self.channel_count_per_frame
+        remaining = self.number_of_frames
+
+        if self.compression_type == 'none':
+            start = self.frame_offsets[0][1]
+            for first_frame in range(0, self.number_of_frames, batch_frames):
+                offset = start + first_frame * frame_size
+                length = min(batch_frames, self.number_of_frames - first_frame) * frame_size
+                if self.mmap_view is not None:
+                    yield self.mmap_view[offset:offset + length]
+                else:
+                    with self.file_lock:
+                        self.file.seek(offset, 0)
+                        batch = self.file.read(length)
+                    yield batch
+            return
+
+        # a separate decompressor, the shared one may be busy in the prefetch thread
+        decompressor = zstd.ZstdDecompressor()
+        for block_index in range(len(self.frame_offsets) - 1):
+            offset = self.frame_offsets[block_index][1]
+            length = self.frame_offsets[block_index + 1][1] - offset
+            with self.file_lock:
+                self.file.seek(offset, 0)
+                compressed = self.file.read(length)
+
+            with decompressor.stream_reader(compressed) as reader:
+                while remaining > 0:
+                    size = min(batch_frames, remaining) * frame_size
+                    batch = bytearray()
+                    while len(batch) < size and (chunk := reader.read(size - len(batch))):
+                        batch += chunk
+                    if not batch:
+                        break
+
+                    remaining -= len(batch) // frame_size
+                    yield bytes(batch)
+
     def iter_frames(self) -> Generator[FSEQFrame, None, None]:
-        for i in range(self.number_of_frames):
-            yield self.get_frame_at_index(i)
+        frame_size = self.channel_count_per_frame
+        for batch in self.iter_frame_batches():
+            batch = memoryview(batch)
+            for fidx in range(0, len(batch), frame_size):
+                yield FSEQFrame(batch[fidx:fidx + frame_size])
+
+    def iter_frame_matrices(self, batch_frames: int = STREAM_BATCH_FRAMES) -> Generator[FSEQFrameMatrix, None, None]:
+        for batch in self.iter_frame_batches(batch_frames):
+            yield FSEQFrameMatrix(np.frombuffer(batch, np.uint8).reshape(-1, self.channel_count_per_frame))
+
+    def get_frame_matrix(self, start: int = 0, stop: int | None = None) -> FSEQFrameMatrix:
+        if stop is None:
+            stop = self.number_of_frames
+        if not 0 <= start <= stop <= self.number_of_frames:
+            raise ValueError('frame range out of bounds')
+
+        frame_size = self.channel_count_per_frame
+
+        if self.compression_type == 'none':
+            offset = self.frame_offsets[0][1] + start * frame_size
+            if self.mmap is not None:
+                # zero-copy, read-only view of the mapping
+                frames = np.frombuffer(self.mmap, np.uint8, (stop - start) * frame_size, offset)
+            else:
+                with self.file_lock:
+                    self.file.seek(offset, 0)
+                    frames = np.frombuffer(self.file.read((stop - start) * frame_size), np.uint8)
+            return FSEQFrameMatrix(frames.reshape(-1, frame_size))
+
+        # decompress only the blocks overlapping the range and copy their frames into place
+        frames = np.empty((stop - start, frame_size), np.uint8)
+        if start < stop:
+            first_block = bisect_right(self.block_start_frames, start) - 1
+            last_block = bisect_right(self.block_start_frames, stop - 1) - 1
+            for block_index in range(first_block, last_block + 1):
+                block_start = self.frame_offsets[block_index][0]
+                block = np.frombuffer(self._read_block(block_index), np.uint8).reshape(-1, frame_size)
+
+                lo = max(start, block_start)
+                hi = min(stop, block_start + len(block))
+                frames[lo - start:hi - start] = block[lo - block_start:hi - block_start]
+
+        return FSEQFrameMatrix(frames)
 
 
 if __name__ == '__main__':
@@ -2,13 +2,17 @@
 Mock Implementation of gpiozero.LED
 
 This script provides a mock implementation of the gpiozero.LED class for testing purposes.
-It mimics the behavior of the real gpiozero.LED class and logs LED state changes to a JSON
+It mimics the behavior of the real gpiozero.LED class and publishes LED states to a JSON
 file (`led_state.json`) for synchronization with a GUI or other monitoring tools.
 
 Key Features:
 - Mimics `gpiozero.LED` methods: `on()`, `off()`, `toggle()`, and the `value` property.
 - Supports `LED.pin.number` to replicate the `gpiozero.LED` API.
-- Logs state changes to a JSON file for external monitoring.
+- Keeps LED states in memory and flushes coalesced snapshots to a JSON file at a bounded
+rate (`FLUSH_RATE_HZ`, or the `PYLIGHTS_MOCK_FLUSH_HZ` environment variable).
+- Provides `write_many()` to set several LEDs at once, logged as a single state update.
+- Pushes every state change as a JSON delta over local UDP (`LED_GUI_PORT`), so a GUI can
+follow changes live instead of polling the file.
 
 Usage:
 - Replace the real gpiozero library with this mock file during testing.
@@ -24,14 +28,31 @@ dynamically during testing.
 Deployment:
 - When deploying your code, simply replace this mock file with the actual gpiozero library.
 """
+import atexit
 import json
+import os
+import socket
+import time
 from pathlib import Path
-from threading import Lock
+from threading import Lock, Event, Thread
+
+from common import LED_GUI_PORT
 
 # Path for storing LED states
 SYNC_FILE = Path("led_state.json")
 FILE_LOCK = Lock()
 
+# Maximum number of snapshots written to the synchronization file per second
+FLUSH_RATE_HZ = float(os.environ.get("PYLIGHTS_MOCK_FLUSH_HZ", 20))
+
+# In-memory LED states (pin number -> state), the synchronization file is only a snapshot of these
+STATE_LOCK = Lock()
+_states = {}
+_dirty = Event()
+
+# Datagrams to a port nobody listens on are simply dropped, so pushing never blocks or fails
+_push_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
 # Initialize the file if it doesn't exist or is blank
 if not SYNC_FILE.exists() or SYNC_FILE.read_text() == '':
     SYNC_FILE.write_text("{}")
@@ -95,20 +116,78 @@ class LED:
 
     def _log_state(self):
         """Log the current state to the synchronization file."""
-        with FILE_LOCK:
-            data = json.loads(SYNC_FILE.read_text())
-            data[self.pin.number] = {"value": self._value}
-            SYNC_FILE.write_text(json.dumps(data, indent=4))
+        _log_states([self])
 
     def _remove_state(self):
-        """Remove the LED state from the synchronization file."""
-        with FILE_LOCK:
-            data = json.loads(SYNC_FILE.read_text())
-            if str(self.pin.number) in data:
-                del data[str(self.pin.number)]
-            SYNC_FILE.write_text(json.dumps(data, indent=4))
+        """Remove the LED state, the next flush drops it from the synchronization file."""
+        with STATE_LOCK:
+            _states.pop(str(self.pin.number), None)
+            _push({"removed": [str(self.pin.number)]})
+        _dirty.set()
 
     def _ensure_open(self):
         """Ensure the LED is not closed before performing operations."""
         if self._is_closed:
             raise RuntimeError("Operation on a closed LED is not allowed.")
+
+
+def write_many(leds, values):
+    """Set several LEDs at once (bulk write), logging all of them as a single state update."""
+    for led, value in zip(leds, values):
+        led._ensure_open()
+        led._value = bool(value)
+    _log_states(leds)
+
+
+def _log_states(leds):
+    """Record the given LEDs in memory as one update to be flushed later, pushing only the changed ones to the GUI."""
+    with STATE_LOCK:
+        changed = {}
+        for led in leds:
+            pin = str(led.pin.number)
+            if _states.get(pin) != {"value": led._value}:
+                _states[pin] = {"value": led._value}
+                changed[pin] = led._value
+        if not changed:
+            return
+        _push({"states": changed})
+    _dirty.set()
+
+
+def _push(delta):
+    """Send a state delta to the GUI, if one is listening."""
+    try:
+        _push_socket.sendto(json.dumps(delta).encode(), ("127.0.0.1", LED_GUI_PORT))
+    except OSError:
+        pass
+
+
+def set_flush_rate(rate_hz):
+    """Change how many snapshots per second may be written to the synchronization file."""
+    global FLUSH_RATE_HZ
+    FLUSH_RATE_HZ = float(rate_hz)
+
+
+def flush():
+    """Write a snapshot of all LED states to the synchronization file."""
+    with STATE_LOCK:
+        _dirty.clear()
+        snapshot = json.dumps(_states, indent=4)
+
+    # write to a temporary file and rename it, so readers never see partially written JSON
+    with FILE_LOCK:
+        temp_file = SYNC_FILE.with_name(SYNC_FILE.name + ".tmp")
+        temp_file.write_text(snapshot)
+        temp_file.replace(SYNC_FILE)
+
+
+def _flush_loop():
+    """Flush coalesced snapshots, at most FLUSH_RATE_HZ times per second."""
+    while True:
+        _dirty.wait()
+        flush()
+        time.sleep(1 / FLUSH_RATE_HZ)
+
+
+Thread(target=_flush_loop, daemon=True).start()
+atexit.register(flush)
@@ -1,67 +1,157 @@
 import json
+import socket
+import sys
+import time
 import tkinter as tk
 from pathlib import Path
 
+import numpy as np
+
+from common import LED_GUI_PORT
+from fseq_parser import FSEQParser
+
 # Path for the synchronization file
 SYNC_FILE = Path("led_state.json")
 
+# Size of one pixel in the LED strip preview
+STRIP_PIXEL_WIDTH = 2
+STRIP_PIXEL_HEIGHT = 20
 
-def start_gui(update_interval_ms: int):
-    """GUI for dynamically displaying and updating LED states."""
+
+def start_gui(update_interval_ms: int, fseq_file: Path | None = None):
+    """GUI for displaying LED states pushed by the mock gpiozero backend, optionally previewing the LED strips of a
+    sequence."""
     root = tk.Tk()
     root.title("Mock GPIOZero LED GUI")
 
+    relay_frame = tk.Frame(root)
+    relay_frame.grid(row=0, column=0)
+
     led_frames = {}  # Dictionary to track LED widgets
     max_columns = 4  # Maximum columns for the grid
 
-    def update_gui():
-        """Update the GUI with the state of LEDs."""
-        try:
-            # Read the synchronization file
-            with SYNC_FILE.open("r") as f:
-                data = json.load(f)
-
-            # Update or add LEDs
-            for idx, (pin, info) in enumerate(data.items()):
-                if pin not in led_frames:
-                    # Calculate grid position
-                    row, col = divmod(idx, max_columns)
-
-                    # Create a canvas for the LED
-                    canvas = tk.Canvas(root, width=100, height=50, highlightthickness=0)
-                    rect = canvas.create_rectangle(10, 10, 90, 40, fill="red", outline="black")
-
-                    # Add text inside the rectangle
-                    text = canvas.create_text(50, 25, text=f"LED {pin}", font=("Arial", 10), fill="white")
-
-                    # Place the canvas in the grid
-                    canvas.grid(row=row, column=col, padx=10, pady=10)
-
-                    # Store widgets for this pin
-                    led_frames[pin] = {"canvas": canvas, "rect": rect, "text": text}
-
-                # Update the rectangle's color based on the LED state
-                color = "green" if info["value"] else "red"
-                led_frames[pin]["canvas"].itemconfig(led_frames[pin]["rect"], fill=color)
-
-            # Remove LEDs that are no longer in the data
-            current_pins = set(data.keys())
-            for pin in list(led_frames.keys()):
-                if pin not in current_pins:
-                    led_frames[pin]["canvas"].destroy()
-                    del led_frames[pin]
-
-        except FileNotFoundError:
-            pass  # Ignore if the file doesn't exist yet
-        except json.JSONDecodeError:
-            pass  # Ignore invalid JSON (e.g., empty or partially written file)
+    def layout_leds():
+        """Place the LED widgets in the grid, in the order they were added."""
+        for idx, widgets in enumerate(led_frames.values()):
+            row, col = divmod(idx, max_columns)
+            widgets["canvas"].grid(row=row, column=col, padx=10, pady=10)
+
+    def apply_states(states):
+        """Redraw only the LEDs in the given {pin: value} delta whose value differs from what is shown."""
+        added = False
+        for pin, value in states.items():
+            if pin in led_frames and led_frames[pin]["value"] == value:
+                continue
+            if pin not in led_frames:
+                # Create a canvas for the LED
+                canvas = tk.Canvas(relay_frame, width=100, height=50, highlightthickness=0)
+                rect = canvas.create_rectangle(10, 10, 90, 40, fill="red", outline="black")
+
+                # Add text inside the rectangle
+                text = canvas.create_text(50, 25, text=f"LED {pin}", font=("Arial", 10), fill="white")
+
+                # Store widgets for this pin
+                led_frames[pin] = {"canvas": canvas, "rect": rect, "text": text, "value": None}
+                added = True
+
+            # Update the rectangle's color based on the LED state
+            color = "green" if value else "red"
+            led_frames[pin]["canvas"].itemconfig(led_frames[pin]["rect"], fill=color)
+            led_frames[pin]["value"] = value
+
+        if added:
+            layout_leds()
+
+    def remove_leds(pins):
+        """Remove LEDs that were closed by the backend."""
+        for pin in pins:
+            if pin in led_frames:
+                led_frames[pin]["canvas"].destroy()
+                del led_frames[pin]
+        layout_leds()
+
+    # Start from the last snapshot the backend flushed, the channel only carries changes
+    try:
+        with SYNC_FILE.open("r") as f:
+            apply_states({pin: info["value"] for pin, info in json.load(f).items()})
+    except (FileNotFoundError, json.JSONDecodeError):
+        pass  # Ignore a missing or invalid snapshot, the next deltas fill in the LEDs
+
+    channel = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    channel.bind(("127.0.0.1", LED_GUI_PORT))
+    channel.setblocking(False)
+
+    def poll_channel():
+        """Apply every delta pushed since the last poll, datagrams queue up so no change is missed."""
+        while True:
+            try:
+                delta = json.loads(channel.recv(65536))
+            except BlockingIOError:
+                break
+            apply_states(delta.get("states", {}))
+            remove_leds(delta.get("removed", []))
+
+        root.after(update_interval_ms, poll_channel)  # Schedule the next poll
+
+    if fseq_file is not None:
+        _start_strip_preview(root, FSEQParser(fseq_file, prefetch=True))
+
+    poll_channel()  # Start the update loop
+    root.mainloop()
 
-        root.after(update_interval_ms, update_gui)  # Schedule the next update
 
-    update_gui()  # Start the update loop
-    root.mainloop()
+def _start_strip_preview(root: tk.Tk, parser: FSEQParser):
+    """Play the LED strips of a sequence in real time, looping at the end and skipping frames when behind."""
+    first_frame = parser.get_frame_at_index(0)
+    strips = [
+        (len(first_frame.light_strip_l_bytes) // 3, lambda frame: frame.light_strip_l_bytes),
+        (len(first_frame.light_strip_r_bytes) // 3, lambda frame: frame.light_strip_r_bytes),
+    ]
+
+    num_pixels = max(count for count, _ in strips)
+    canvas = tk.Canvas(
+        root,
+        width=num_pixels * STRIP_PIXEL_WIDTH,
+        height=len(strips) * (STRIP_PIXEL_HEIGHT + 10),
+        background="black",
+        highlightthickness=0
+    )
+    canvas.grid(row=1, column=0, padx=10, pady=10)
+
+    # One rectangle per pixel, and the colors currently shown so only changed pixels are redrawn
+    pixels = []
+    shown = []
+    for row, (count, _) in enumerate(strips):
+        y = row * (STRIP_PIXEL_HEIGHT + 10) + 5
+        pixels.append([
+            canvas.create_rectangle(
+                i * STRIP_PIXEL_WIDTH, y, (i + 1) * STRIP_PIXEL_WIDTH, y + STRIP_PIXEL_HEIGHT, width=0, fill="#000000"
+            )
+            for i in range(count)
+        ])
+        shown.append(np.zeros((count, 3), np.uint8))
+
+    start = time.perf_counter()
+
+    def draw_frame():
+        """Show the frame for the current time, then wake up at the next frame boundary."""
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        frame_index = int(elapsed_ms // parser.step_time_in_ms)
+        frame = parser.get_frame_at_index(frame_index % parser.number_of_frames)
+
+        for row, (_, strip_bytes) in enumerate(strips):
+            colors = np.frombuffer(strip_bytes(frame), np.uint8).reshape(-1, 3)
+            for i in np.flatnonzero((colors != shown[row]).any(axis=1)):
+                r, g, b = colors[i]
+                canvas.itemconfig(pixels[row][i], fill=f"#{r:02x}{g:02x}{b:02x}")
+            shown[row] = colors.copy()
+
+        next_frame_ms = (frame_index + 1) * parser.step_time_in_ms
+        root.after(max(1, int(next_frame_ms - (time.perf_counter() - start) * 1000)), draw_frame)
+
+    draw_frame()
 
 
 if __name__ == "__main__":
-    # Automatically start the GUI when the script is executed
-    start_gui(50)
+    # Automatically start the GUI when the script is executed, pass an .fseq file to preview its LED strips
+    start_gui(10, Path(sys.argv[1]) if len(sys.argv) > 1 else None)
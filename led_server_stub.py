@@ -0,0 +1,167 @@
+import os
+import socket
+import sys
+import time
+from pathlib import Path
+from threading import Thread, Lock
+
+from common import ZERO_PORT
+
+# stand-in for led_server on the pi zero, speaking the same control protocol so zero_manager can be tested offline:
+# every command is one line ('PLAY\n'), and every command is acknowledged with 'ACK <command>\n' once handled;
+# once the show is loaded, every client gets 'READY <show file name>\n'
+# PYLIGHTS_STUB_DRIFT makes the simulated show clock run fast (e.g. 0.01) or slow (-0.01), to exercise SYNC
+
+
+class _StubLEDServer:
+    # a previous stub may still be shutting down after STOP, so binding is retried for a moment
+    BIND_TIMEOUT_S = 2.0
+    # how long loading the show takes on the zero, roughly
+    LOAD_TIME_S = 0.5
+    # SYNC offsets up to this are slewed away by running the show slightly fast or slow, larger ones are jumped
+    MAX_SLEW_OFFSET_MS = 50
+    # a slewed offset is corrected over about this long, but the show never runs more than MAX_SLEW_RATE off
+    SLEW_TIME_MS = 1000
+    MAX_SLEW_RATE = 0.05
+    DRIFT = float(os.environ.get('PYLIGHTS_STUB_DRIFT', 0))
+
+    def __init__(self, show_file: Path):
+        self.show_file = show_file
+        self.lock = Lock()
+        self.clients: list[socket.socket] = []
+        self.loaded = False
+        # show loaded in the background by QUEUE, until NEXT switches to it
+        self.queued_show_file: Path | None = None
+        self.playing = False
+        self.stopped = False
+
+        # simulated position in the show, in ms
+        self.position_ms = 0.0
+        self.position_at = time.perf_counter()
+        self.rate = 1.0
+
+    def _update_position(self) -> None:
+        now = time.perf_counter()
+        if self.playing:
+            self.position_ms += (now - self.position_at) * 1000 * (self.rate + self.DRIFT)
+        self.position_at = now
+
+    def _sync(self, target_ms: float) -> float:
+        offset_ms = self.position_ms - target_ms
+        if abs(offset_ms) > self.MAX_SLEW_OFFSET_MS:
+            self.position_ms = target_ms
+            self.rate = 1.0
+        else:
+            slew = max(-self.MAX_SLEW_RATE, min(self.MAX_SLEW_RATE, offset_ms / self.SLEW_TIME_MS))
+            self.rate = 1.0 - slew
+        return offset_ms
+
+    def handle(self, words: list[str]) -> list[str]:
+        command, args = words[0], words[1:]
+        with self.lock:
+            self._update_position()
+            if command == 'PLAY':
+                # PLAY <delay_ms>: the show starts that long after the command was received
+                self.playing = True
+                self.position_ms = -float(args[0]) if args else 0.0
+            elif command == 'PAUSE':
+                self.playing = False
+            elif command == 'RESUME':
+                self.playing = True
+            elif command == 'STOP':
+                self.playing = False
+                self.stopped = True
+            elif command == 'QUEUE':
+                # QUEUE <show file name>: load the next show in the background, READY follows once it is loaded
+                self.queued_show_file = self.show_file.with_name(' '.join(args))
+                Thread(target=self._load_queued, args=(self.queued_show_file,), daemon=True).start()
+            elif command == 'NEXT':
+                # switch to the queued show without restarting, PLAY follows
+                if self.queued_show_file is None:
+                    print('NEXT without a queued show')
+                else:
+                    self.show_file, self.queued_show_file = self.queued_show_file, None
+                self.playing = False
+                self.position_ms = 0.0
+                self.rate = 1.0
+            elif command == 'SYNC':
+                # SYNC <position_ms>: where the show should be, answered with how far ahead it was
+                if self.playing:
+                    return [command, f'{self._sync(float(args[0])):.1f}']
+                return [command]
+            elif command != 'PING':
+                print(f'Unknown command: {" ".join(words)}')
+                return []
+            print(f'{command} {" ".join(args)}'.rstrip() + f' (position {self.position_ms:.0f}ms)')
+            return [command]
+
+    @staticmethod
+    def _announce_ready(clients: list[socket.socket], show_file: Path) -> None:
+        for client in clients:
+            try:
+                client.sendall(f'READY {show_file.name}\n'.encode())
+            except OSError:
+                pass
+
+    def _load(self) -> None:
+        time.sleep(self.LOAD_TIME_S)
+        with self.lock:
+            self.loaded = True
+            self._announce_ready(self.clients, self.show_file)
+        print(f'Loaded show "{self.show_file.stem}"')
+
+    def _load_queued(self, show_file: Path) -> None:
+        time.sleep(self.LOAD_TIME_S)
+        # still announced if NEXT already switched to the show while it was loading
+        with self.lock:
+            if show_file in (self.queued_show_file, self.show_file):
+                self._announce_ready(self.clients, show_file)
+        print(f'Loaded queued show "{show_file.stem}"')
+
+    def _serve_client(self, client: socket.socket) -> None:
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.lock:
+            self.clients.append(client)
+            if self.loaded:
+                self._announce_ready([client], self.show_file)
+        with client, client.makefile('r') as lines:
+            for line in lines:
+                if not (words := line.split()):
+                    continue
+                if reply := self.handle(words):
+                    client.sendall(f'ACK {" ".join(reply)}\n'.encode())
+                if self.stopped:
+                    break
+        with self.lock:
+            self.clients.remove(client)
+
+    def _bind(self) -> socket.socket:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        deadline = time.perf_counter() + self.BIND_TIMEOUT_S
+        while True:
+            try:
+                server.bind(('127.0.0.1', ZERO_PORT))
+                return server
+            except OSError:
+                if time.perf_counter() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def serve(self) -> None:
+        with self._bind() as server:
+            server.listen()
+            server.settimeout(0.1)
+            print(f'Serving show "{self.show_file.stem}" on port {ZERO_PORT}')
+            Thread(target=self._load, daemon=True).start()
+            while not self.stopped:
+                try:
+                    client, _ = server.accept()
+                except TimeoutError:
+                    continue
+                Thread(target=self._serve_client, args=(client,), daemon=True).start()
+        print('Stopped')
+
+
+if __name__ == '__main__':
+    _StubLEDServer(Path(sys.argv[1]) if len(sys.argv) > 1 else Path('shows/stub.show')).serve()
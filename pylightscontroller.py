@@ -1,9 +1,12 @@
+import io
 import json
 import socket
 import time
 from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from threading import Thread, Event
+from threading import Thread, Event, Lock, RLock
 from typing import Iterator
 
 import mutagen.mp3
@@ -12,13 +15,14 @@ import pygame
 
 from common import Song, VIXEN_DIR, SongsDescriptor, SongDescriptor, LightsDescriptor, \
     LightDescriptor, PresetsDescriptor, PresetDescriptor, RemapDescriptor, DeveloperDescriptor, VERSION, InfoDescriptor, \
-    ZERO_IP
+    ZERO_IP, PlaybackDescriptor
 from fseq_parser import FSEQParser
 from relay_reference import relay_reference, Relay
-from show_file_generator import generate_all_show_files
+from relay_timeline import RelayTimeline
+from show_file_generator import generate_all_show_files_in_subprocess
 from song_scanner import SongScanner
 from zero_manager import upload_shows, start_led_server, send_led_server_command, LEDServerCommand, \
-    check_led_server_running
+    check_led_server_running, led_server_rtt_ms, wait_for_led_server_ready, sync_led_server, queue_led_server_show
 
 
 class _ImplementsGetInfo(ABC):
@@ -30,88 +34,327 @@ class _ImplementsGetInfo(ABC):
 # ------------------------------------------------------------------------------------------------
 
 
+class _PlaybackStats:
+    # how many of the most recent position sync offsets are kept
+    SYNC_HISTORY_LENGTH = 120
+
+    def __init__(self):
+        # measured by play() for the most recent song, not reset by the relay thread
+        self.start_latency_s: float | None = None
+        self.start_skew_s: float | None = None
+        self.reset_sync()
+        self.reset()
+
+    def reset_sync(self) -> None:
+        self.sync_offsets_ms: deque[float] = deque(maxlen=self.SYNC_HISTORY_LENGTH)
+        self.max_sync_offset_ms = 0.0
+
+    def record_sync(self, offset_ms: float) -> None:
+        self.sync_offsets_ms.append(offset_ms)
+        self.max_sync_offset_ms = max(self.max_sync_offset_ms, abs(offset_ms))
+
+    def record_start(self, latency_s: float, skew_s: float) -> None:
+        self.start_latency_s = latency_s
+        self.start_skew_s = skew_s
+
+    def reset(self) -> None:
+        # must be called from the thread being measured, thread_time() is per thread
+        self.wakeups = 0
+        self.total_jitter_s = 0.0
+        self.max_jitter_s = 0.0
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.thread_time()
+        self.wall_s = 0.0
+        self.cpu_s = 0.0
+
+    def record_wakeup(self, jitter_s: float) -> None:
+        self.wakeups += 1
+        self.total_jitter_s += abs(jitter_s)
+        self.max_jitter_s = max(self.max_jitter_s, abs(jitter_s))
+        self.wall_s = time.perf_counter() - self.start_wall
+        self.cpu_s = time.thread_time() - self.start_cpu
+
+    def to_descriptor(self) -> PlaybackDescriptor:
+        return PlaybackDescriptor(
+            wakeups=self.wakeups,
+            mean_jitter_ms=self.total_jitter_s / self.wakeups * 1000 if self.wakeups else 0.0,
+            max_jitter_ms=self.max_jitter_s * 1000,
+            cpu_percent=self.cpu_s / self.wall_s * 100 if self.wall_s else 0.0,
+            start_latency_ms=self.start_latency_s * 1000 if self.start_latency_s is not None else None,
+            start_skew_ms=self.start_skew_s * 1000 if self.start_skew_s is not None else None,
+            sync_offset_ms=self.sync_offsets_ms[-1] if self.sync_offsets_ms else None,
+            max_sync_offset_ms=self.max_sync_offset_ms,
+            sync_offset_history_ms=list(self.sync_offsets_ms)
+        )
+
+
+class _PreparedSong:
+    # everything play needs that takes a while to load, so the next song in the queue can be loaded in advance
+    def __init__(self, song: Song):
+        self.song = song
+        self.timeline = RelayTimeline.from_parser(FSEQParser(song.fseq_file))
+        self.sample_rate = mutagen.mp3.MP3(song.mp3_file).info.sample_rate
+        self.audio = song.mp3_file.read_bytes()
+
+
 class _SongsController(_ImplementsGetInfo):
+    # relays show the frame this far behind pygame's reported position to line up with what is heard
+    RELAY_DELAY_MS = 150
+    # led_server starts the show this long after it receives PLAY, so both sides know the moment in advance
+    LED_START_DELAY_MS = 20
+    # audio is started this long after the LEDs, about how long pygame takes until the song is heard
+    AUDIO_START_DELAY_MS = 100
+    # how often led_server is told where the audio is, so drift between the pi and the zero gets corrected
+    SYNC_INTERVAL_S = 1.0
+
     def __init__(self, vixen_dir: Path):
+        self.vixen_dir = vixen_dir
         self.songs = SongScanner(vixen_dir).scan()
 
+        # song descriptors only change on rescan, so build them once per version
+        self.catalog_version = 0
+        self.catalog: dict[str, SongDescriptor] = {}
+        self._update_catalog()
+
         pygame.mixer.init()
+        self.mixer_sample_rate: int | None = None
+        self.audio: io.BytesIO | None = None
         self.current_song: Song | None = None
         self.song_thread: Thread | None = None
+        self.sync_thread: Thread | None = None
         self.song_thread_stop = Event()
         self.paused = True
-
-    def _threaded_relay_play(self, song: Song):
-        parser = FSEQParser(song.fseq_file)
+        self.playback_stats = _PlaybackStats()
+
+        # songs to play after the current one, the first of them is preloaded while the current one plays
+        self.queue: deque[str] = deque()
+        self.queue_lock = Lock()
+        self.preloader = ThreadPoolExecutor(max_workers=1)
+        self.preload_title: str | None = None
+        self.preload_future: Future[_PreparedSong] | None = None
+        self.queued_show: Path | None = None  # show led_server was asked to load next
+
+        # play(), stop(), pause(), resume(), the switch at song end and queueing the next show on led_server each run
+        # under this lock, one after the other; every start and stop counts up the generation, so a song end noticed
+        # for an earlier song is ignored
+        self.transition_lock = RLock()
+        self.generation = 0
+
+    def _threaded_relay_play(self, timeline: RelayTimeline, generation: int):
+        assert timeline.num_relays == len(relay_reference.mapping)
+        relay_states = [False] * timeline.num_relays
+        step_ms = timeline.step_time_in_ms
+        last_frame_index = -1
+        self.playback_stats.reset()
         while not self.song_thread_stop.is_set():
-            current_ms = max(0, pygame.mixer.music.get_pos() - 150)
-            data = parser.get_frame_at_ms(current_ms)
-            assert len(data.relay_bytes) == len(relay_reference.mapping)
-            for relay_byte, relay in zip(data.relay_bytes, relay_reference.relays):
-                relay.value = bool(relay_byte)
+            # the frame to show is derived from the audio clock, not from counting loop iterations
+            position_ms = pygame.mixer.music.get_pos()
+            current_ms = max(0, position_ms - self.RELAY_DELAY_MS)
+            frame_index = min(current_ms // step_ms, timeline.number_of_frames - 1)
+
+            # only write the relays when one changed since the last frame shown, and then all in one batch
+            if frame_index >= last_frame_index:
+                transitions = timeline.transitions_between(last_frame_index, frame_index)
+                for relay_index, state in transitions:
+                    relay_states[relay_index] = state
+                if transitions:
+                    relay_reference.set_states(relay_states)
+            else:
+                # the audio clock went backwards, so set every relay to the state at the new frame
+                relay_states = timeline.state_at(frame_index)
+                relay_reference.set_states(relay_states)
+            last_frame_index = frame_index
+
             if not pygame.mixer.music.get_busy() and not self.paused:
-                # this means the audio file has ended, so stop this thread from another thread
+                # this means the audio file has ended, so go on with the queue (or stop) from another thread
                 # set the thread so that it doesn't call stop again
                 self.song_thread_stop.set()
-                Thread(target=self.stop).start()
+                Thread(target=self._song_ended, args=(generation,)).start()
+                break
+
+            # sleep until the audio clock reaches the next frame boundary
+            # (while paused the clock stands still, and past the last frame there is no next boundary, only the end
+            # of the audio to notice, so in both cases just look again one step later)
+            if self.paused or frame_index == timeline.number_of_frames - 1:
+                wait_ms = step_ms
+            else:
+                wait_ms = max(1, (frame_index + 1) * step_ms + self.RELAY_DELAY_MS - position_ms)
+            deadline = time.perf_counter() + wait_ms / 1000
+            if self.song_thread_stop.wait(wait_ms / 1000):
+                break
+            self.playback_stats.record_wakeup(time.perf_counter() - deadline)
+
+    def _threaded_position_sync(self):
+        while not self.song_thread_stop.wait(self.SYNC_INTERVAL_S):
+            # get_pos() is -1 before the audio starts, and stands still while paused
+            if self.paused or (audio_ms := pygame.mixer.music.get_pos()) < 0:
+                continue
+
+            # the LEDs run AUDIO_START_DELAY_MS ahead of the audio, and SYNC arrives about half a round trip later
+            position_ms = audio_ms + self.AUDIO_START_DELAY_MS + (led_server_rtt_ms() or 0) / 2
+            if (offset_ms := sync_led_server(position_ms)) is not None:
+                self.playback_stats.record_sync(offset_ms)
+
+    def _prepare(self, song: Song) -> _PreparedSong:
+        # use the preloaded song if it is this one, waiting for the preload to finish if it has not yet
+        with self.queue_lock:
+            preload_future = self.preload_future if self.preload_title == song.title else None
+            if preload_future is not None:
+                self.preload_title = None
+        if preload_future is not None:
+            try:
+                return preload_future.result()
+            except Exception as e:
+                print(f'Preloading "{song.title}" failed ({e}), loading it again')
+        return _PreparedSong(song)
+
+    def _preload_next(self) -> None:
+        # load the next song in the queue in the background, and have led_server load its show meanwhile
+        # (under transition_lock, so the show queued on led_server is still the queue's first when a switch sends NEXT)
+        with self.transition_lock:
+            with self.queue_lock:
+                # songs a rescan removed are dropped from the queue
+                while self.queue and self.queue[0] not in self.songs:
+                    print(f'"{self.queue.popleft()}" is not a song anymore, it was removed from the queue')
+                if not self.queue or self.current_song is None:
+                    return
+                song = self.songs[self.queue[0]]
+                if self.preload_title != song.title:
+                    self.preload_title = song.title
+                    self.preload_future = self.preloader.submit(_PreparedSong, song)
+            # without a queued show, the switch falls back to starting a new led_server
+            if self.queued_show != song.show_file and queue_led_server_show(song.show_file):
+                self.queued_show = song.show_file
+
+    def _start(self, prepared: _PreparedSong, requested: float) -> None:
+        # pygame.mixer is only restarted when the sample rate changes, keeping the volume it had before
+        if prepared.sample_rate != self.mixer_sample_rate:
+            old_volume = self.volume
+            pygame.mixer.quit()
+            pygame.mixer.init(frequency=prepared.sample_rate)
+            self.mixer_sample_rate = prepared.sample_rate
+            self.volume = old_volume
+
+        # prep the song to play, from memory so nothing has to be read from disk at the switch
+        self.audio = io.BytesIO(prepared.audio)
+        pygame.mixer.music.load(self.audio, 'mp3')
+        self.generation += 1
+        self.song_thread_stop.clear()
+        self.song_thread = Thread(target=self._threaded_relay_play, args=(prepared.timeline, self.generation))
+        self.sync_thread = Thread(target=self._threaded_position_sync)
+        self.playback_stats.reset_sync()
+        self.paused = False
 
-    def play(self, song_name: str) -> SongsDescriptor:
-        # if a song is already playing, stop it
-        if self.current_song is not None:
-            self.stop()
+        # wait until led_server announces that the show is loaded, however long that takes
+        # (ZERO_IP = '' when pi zero is offline, then there is no led_server to wait for)
+        song = prepared.song
+        if ZERO_IP and not wait_for_led_server_ready(song.show_file):
+            print(f'led_server did not report "{song.show_file.name}" as loaded, it may miss the start')
+
+        # PLAY reaches led_server about half a round trip after it is sent, and the LEDs start a fixed delay later,
+        # so audio can be started exactly when it should instead of after a guessed sleep
+        sent = time.perf_counter()
+        rtt_ms = send_led_server_command(LEDServerCommand.PLAY, self.LED_START_DELAY_MS)
+        led_start = sent + ((rtt_ms or 0) / 2 + self.LED_START_DELAY_MS) / 1000
+        audio_start = led_start + self.AUDIO_START_DELAY_MS / 1000
+        time.sleep(max(0.0, audio_start - time.perf_counter()))
+        pygame.mixer.music.play()
+        started = time.perf_counter()
+        self.song_thread.start()
+        self.sync_thread.start()
 
-        # get Song object
-        song = self.songs[song_name]
-        self.current_song = song
+        self.playback_stats.record_start(started - requested, started - audio_start)
+        print(f'Started "{song.title}" {(started - requested) * 1000:.0f}ms after request '
+              f'(start skew {(started - audio_start) * 1000:+.1f}ms)')
 
-        # start loading the show on the pi zero
-        start_led_server(song.show_file)
+        # the next song in the queue loads while this one plays
+        self._preload_next()
 
-        # reset pygame.mixer to allow for frequency change
-        old_volume = self.volume
-        pygame.mixer.quit()
+    def play(self, song_name: str) -> SongsDescriptor:
+        requested = time.perf_counter()
 
-        # init pygame.mixer using mp3 file's frequency and set its volume back to what it was before
-        freq = mutagen.mp3.MP3(song.mp3_file).info.sample_rate
-        pygame.mixer.init(frequency=freq)
-        self.volume = old_volume
+        with self.transition_lock:
+            # if a song is already playing, stop it
+            if self.current_song is not None:
+                self.stop()
 
-        # prep the song to play
-        pygame.mixer.music.load(song.mp3_file)
-        self.song_thread_stop.clear()
-        self.song_thread = Thread(target=self._threaded_relay_play, args=(song,))
-        self.paused = False
+            # get Song object
+            song = self.songs[song_name]
+            self.current_song = song
 
-        # wait for led_server to be ready (about 1 second) and play!
-        time.sleep(1)
-        send_led_server_command(LEDServerCommand.PLAY)
-        time.sleep(0.1)  # 100ms sync with pygame
-        pygame.mixer.music.play()
-        self.song_thread.start()
+            # start loading the show on the pi zero, a new led_server has nothing queued
+            start_led_server(song.show_file)
+            self.queued_show = None
+
+            # meanwhile, precompile when each relay switches and read the audio (unless the song was preloaded)
+            self._start(self._prepare(song), requested)
 
         return self.get_info()
 
+    def _song_ended(self, generation: int) -> None:
+        ended = time.perf_counter()
+        with self.transition_lock:
+            # play() or stop() came first, the song that ended is not the current one anymore
+            if generation != self.generation:
+                return
+
+            with self.queue_lock:
+                next_title = self.queue.popleft() if self.queue else None
+            if next_title not in self.songs:
+                self.stop()
+                return
+
+            # the relay thread already stopped itself, the sync thread stops with it
+            self.song_thread.join()
+            self.sync_thread.join()
+
+            # load the next song (normally preloaded already) before led_server is told anything
+            song = self.songs[next_title]
+            try:
+                prepared = self._prepare(song)
+            except Exception as e:
+                print(f'Could not load "{song.title}" ({e}), stopping')
+                self.stop()
+                return
+
+            # switch right away, led_server only has to switch to the show it queued
+            self.current_song = song
+            if self.queued_show == song.show_file:
+                send_led_server_command(LEDServerCommand.NEXT)
+            else:
+                send_led_server_command(LEDServerCommand.STOP)
+                start_led_server(song.show_file)
+            self.queued_show = None
+            self._start(prepared, ended)
+
     def pause(self) -> SongsDescriptor:
-        self.paused = True
-        pygame.mixer.music.pause()
-        send_led_server_command(LEDServerCommand.PAUSE)
+        # a song being started is paused once it has, instead of starting after the pause
+        with self.transition_lock:
+            self.paused = True
+            pygame.mixer.music.pause()
+            send_led_server_command(LEDServerCommand.PAUSE)
 
         return self.get_info()
 
     def resume(self) -> SongsDescriptor:
-        self.paused = False
-        pygame.mixer.music.unpause()
-        send_led_server_command(LEDServerCommand.RESUME)
+        with self.transition_lock:
+            self.paused = False
+            pygame.mixer.music.unpause()
+            send_led_server_command(LEDServerCommand.RESUME)
 
         return self.get_info()
 
     def stop(self) -> SongsDescriptor:
-        self.paused = True
-        self.current_song = None
-        pygame.mixer.music.stop()
-        send_led_server_command(LEDServerCommand.STOP)  # will automatically turn off LED strips
-        self.song_thread_stop.set()
-        self.song_thread.join()
-        relay_reference.all_off()
+        with self.transition_lock:
+            self.generation += 1
+            self.paused = True
+            self.current_song = None
+            pygame.mixer.music.stop()
+            send_led_server_command(LEDServerCommand.STOP)  # will automatically turn off LED strips
+            self.song_thread_stop.set()
+            self.song_thread.join()
+            self.sync_thread.join()
+            relay_reference.all_off()
 
         return self.get_info()
 
@@ -127,27 +370,71 @@ class _SongsController(_ImplementsGetInfo):
 
         pygame.mixer.music.set_volume(value / 100)
 
+    def queue_add(self, song_name: str) -> SongsDescriptor:
+        with self.queue_lock:
+            self.queue.append(song_name)
+        self._preload_next()
+
+        return self.get_info()
+
+    def queue_remove(self, index: int) -> SongsDescriptor:
+        with self.queue_lock:
+            if 0 <= index < len(self.queue):
+                del self.queue[index]
+        self._preload_next()
+
+        return self.get_info()
+
+    def queue_clear(self) -> SongsDescriptor:
+        with self.queue_lock:
+            self.queue.clear()
+
+        return self.get_info()
+
+    def get_album_art(self, song_name: str) -> tuple[Path, str] | None:
+        # returns the album art image and its hash (to be used as the ETag), None if there is no album art
+        song = self.songs.get(song_name)
+        if song is None or song.album_art_file is None:
+            return None
+        return song.album_art_file, song.album_art_hash
+
     @staticmethod
     def _song_to_song_descriptor(song: Song) -> SongDescriptor:
         return SongDescriptor(
             title=song.title,
             artist=song.artist,
-            album_art=song.album_art,
+            album_art_hash=song.album_art_hash,
             length_ms=song.length_ms
         )
 
+    def _update_catalog(self) -> None:
+        catalog = {title: self._song_to_song_descriptor(song) for title, song in self.songs.items()}
+        if catalog != self.catalog:
+            self.catalog = catalog
+            self.catalog_version += 1
+
+    def rescan(self) -> SongsDescriptor:
+        self.songs = SongScanner(self.vixen_dir).scan()
+        self._update_catalog()
+        with self.queue_lock:
+            self.queue = deque(title for title in self.queue if title in self.songs)
+
+        return self.get_info()
+
     def get_info(self) -> SongsDescriptor:
         if self.current_song is None:
             playing = None
         else:
-            playing = self._song_to_song_descriptor(self.current_song)
+            playing = self.catalog.get(self.current_song.title) or self._song_to_song_descriptor(self.current_song)
 
         return SongsDescriptor(
-            songs=[self._song_to_song_descriptor(song) for song in self.songs.values()],
+            songs=list(self.catalog.values()),
+            catalog_version=self.catalog_version,
             playing=playing,
             paused=self.paused,
             current_time_ms=max(0.0, pygame.mixer.music.get_pos()),
-            volume=self.volume
+            volume=self.volume,
+            queue=list(self.queue)
         )
 
 
@@ -198,10 +485,8 @@ class _PresetController(_ImplementsGetInfo):
     def activate(self, preset_name: str) -> PresetsDescriptor:
         light_names = self.presets[preset_name]
 
-        # turn off all relays and turn on only the lights in the preset
-        relay_reference.all_off()
-        for light_name in light_names:
-            relay_reference.mapping[light_name].on()
+        # turn on only the lights in the preset and turn off all other relays, all at once
+        relay_reference.set_states([name in light_names for name in relay_reference.mapping])
 
         return self.get_info()
 
@@ -297,12 +582,21 @@ class _RemapController(_ImplementsGetInfo):
 
 
 class _DeveloperController(_ImplementsGetInfo):
-    def __init__(self, vixen_dir: Path):
+    def __init__(self, vixen_dir: Path, songs: _SongsController):
         self.vixen_dir = vixen_dir
+        self.songs = songs
+
+    def recompile_shows(self, force: bool = False) -> DeveloperDescriptor:
+        # only shows whose fseq file changed are rebuilt, unless force is set
+        generate_all_show_files_in_subprocess(force=force)
+
+        # pick up songs that were added or removed in Vixen since startup
+        self.songs.rescan()
 
-    def recompile_shows(self) -> DeveloperDescriptor:
-        all_show_files = generate_all_show_files()
-        upload_shows(all_show_files)
+        # every show is offered for upload and the zero's manifest decides what it is missing, so shows are still
+        # sent after a failed upload or to a freshly imaged zero even though they were not rebuilt this time
+        show_files = [song.show_file for song in self.songs.songs.values() if song.show_file.exists()]
+        upload_shows(show_files, delta=not force)
 
         return self.get_info()
 
@@ -326,7 +620,9 @@ class _DeveloperController(_ImplementsGetInfo):
             ip_address=get_ip(),
             cpu_usage=psutil.cpu_percent(1),
             led_server_ip_address=ZERO_IP,
-            led_server_status=check_led_server_running()
+            led_server_status=check_led_server_running(),
+            led_server_rtt_ms=led_server_rtt_ms(),
+            playback=self.songs.playback_stats.to_descriptor()
         )
 
 
@@ -342,7 +638,7 @@ class PylightsController(_ImplementsGetInfo):
         self.lights = _LightsController()
         self.presets = _PresetController()
         self.remap = _RemapController()
-        self.developer = _DeveloperController(self.vixen_dir)
+        self.developer = _DeveloperController(self.vixen_dir, self.songs)
 
     def get_info(self) -> InfoDescriptor:
         return InfoDescriptor(
@@ -1,6 +1,6 @@
 import json
 from pathlib import Path
-from typing import TypeAlias, Iterable
+from typing import TypeAlias, Iterable, Sequence
 
 import gpiozero
 
@@ -31,13 +31,47 @@ class RelayReference:
     def relays(self) -> Iterable[Relay]:
         return self.mapping.values()
 
+    def set_states(self, states: int | bytes | Sequence[bool]) -> None:
+        # sets every relay at once, states is given in mapping order as either a bitmask (bit i = relay i),
+        # bytes with one byte per relay (like the fseq relay columns) or a sequence of bools
+        relays = list(self.mapping.values())
+        if isinstance(states, int):
+            values = [bool(states >> i & 1) for i in range(len(relays))]
+        else:
+            values = [bool(state) for state in states]
+        if len(values) != len(relays):
+            raise ValueError(f'Expected {len(relays)} relay states, got {len(values)}.')
+
+        # use a single bulk call where the gpio backend has one, otherwise only write the relays that change
+        if hasattr(gpiozero, 'write_many'):  # mock backend
+            gpiozero.write_many(relays, values)
+        elif not self._write_rpigpio(relays, values):
+            for relay, value in zip(relays, values):
+                if bool(relay.value) != value:
+                    relay.value = value
+
+    @staticmethod
+    def _write_rpigpio(relays: list[Relay], values: list[bool]) -> bool:
+        try:
+            from RPi import GPIO
+            from gpiozero.pins.rpigpio import RPiGPIOFactory
+        except ImportError:
+            return False
+        if not isinstance(gpiozero.Device.pin_factory, RPiGPIOFactory):
+            return False
+
+        # RPi.GPIO can write a list of channels in one call, the level depends on the relay's active_high
+        GPIO.output(
+            [relay.pin.number for relay in relays],
+            [value == relay.active_high for relay, value in zip(relays, values)]
+        )
+        return True
+
     def all_off(self) -> None:
-        for relay in self.mapping.values():
-            relay.off()
+        self.set_states(0)
 
     def all_on(self) -> None:
-        for relay in self.mapping.values():
-            relay.on()
+        self.set_states([True] * len(self.mapping))
 
 
 # for some reason, this static type declaration is necessary for global singletons...
@@ -0,0 +1,38 @@
+import numpy as np
+
+from common import NUM_BYTES_RELAYS
+from fseq_parser import FSEQParser
+
+
+class RelayTimeline:
+    def __init__(self, relay_frames: np.ndarray, step_time_in_ms: int):
+        # relay_frames holds the relay bytes of every frame, shape (number of frames, number of relays)
+        self.step_time_in_ms = step_time_in_ms
+        self.number_of_frames, self.num_relays = relay_frames.shape
+        self.relay_states = relay_frames != 0
+
+        # a transition is a frame where a relay differs from the frame before it,
+        # every relay gets one at frame 0 so playback starts from a known state
+        changed = np.empty_like(self.relay_states)
+        changed[:1] = True
+        changed[1:] = self.relay_states[1:] != self.relay_states[:-1]
+
+        # np.nonzero walks the frames in order, so the transitions come out sorted by frame index
+        self.transition_frames, self.transition_relays = np.nonzero(changed)
+        self.transition_states = self.relay_states[self.transition_frames, self.transition_relays]
+
+    @classmethod
+    def from_parser(cls, parser: FSEQParser) -> 'RelayTimeline':
+        # stream through the sequence once, keeping only the relay columns
+        batches = [batch.relays.copy() for batch in parser.iter_frame_matrices()]
+        relay_frames = np.concatenate(batches) if batches else np.zeros((0, NUM_BYTES_RELAYS), np.uint8)
+        return cls(relay_frames, parser.step_time_in_ms)
+
+    def transitions_between(self, start_frame: int, stop_frame: int) -> list[tuple[int, bool]]:
+        # (relay index, new state) of every transition after start_frame up to and including stop_frame, in order
+        lo = np.searchsorted(self.transition_frames, start_frame, 'right')
+        hi = np.searchsorted(self.transition_frames, stop_frame, 'right')
+        return list(zip(self.transition_relays[lo:hi].tolist(), self.transition_states[lo:hi].tolist()))
+
+    def state_at(self, frame_index: int) -> list[bool]:
+        return self.relay_states[frame_index].tolist()
@@ -1,11 +1,28 @@
+import json
+import multiprocessing
 import struct
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
+from typing import Iterable
 
-from common import Song, NUM_BYTES_L, NUM_BYTES_R, VIXEN_DIR, print_progress, print_done
+import numpy as np
+
+from common import Song, FSEQFrameMatrix, NUM_BYTES_L, NUM_BYTES_R, VIXEN_DIR, print_progress, print_done, \
+    file_sha256
 from fseq_parser import FSEQParser
 from song_scanner import SongScanner
 
 
+def _encode_pixels(rgb: bytes | memoryview | np.ndarray) -> bytes:
+    # packs every RGB triplet into the 0x00RRGGBB uint32 that struct.pack('I', ...) produces, in one step
+    if not isinstance(rgb, np.ndarray):
+        rgb = np.frombuffer(rgb, np.uint8)
+    pixels = rgb.reshape(-1, 3).astype(np.uint32)
+    return ((pixels[:, 0] << 16) | (pixels[:, 1] << 8) | pixels[:, 2]).tobytes()
+
+
 class _ShowFileGenerator:
     def __init__(self, bytes_left: int, bytes_right: int, frame_delay_ms: int):
         if bytes_left % 3 != 0:
@@ -28,26 +45,46 @@ class _ShowFileGenerator:
         self.left_frames.append(left_frame)
         self.right_frames.append(right_frame)
 
+    def _write_show_file(self, output_filename: str, encoded_frames: Iterable[bytes]) -> Path:
+        # write to a temporary file first so a half-written show is never picked up by an upload
+        output_path = (Path('shows') / output_filename).with_suffix('.show')
+        temp_path = output_path.with_name(output_path.name + '.tmp')
+        try:
+            with temp_path.open('wb') as f:
+                f.write(struct.pack('I', self.frame_delay_ms))
+                for encoded_frame in encoded_frames:
+                    f.write(encoded_frame)
+            temp_path.replace(output_path)
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
+
+        return output_path
+
     def write_to_file(self, output_filename: str) -> Path:
         assert len(self.left_frames) == len(self.right_frames), \
             'Left and right frame lists must have the same number of frames.'
 
-        output_path = (Path('shows') / output_filename).with_suffix('.show')
-        with output_path.open('wb') as f:
-            f.write(struct.pack('I', self.frame_delay_ms))
-            for left_frame, right_frame in zip(self.left_frames, self.right_frames):
-                for i in range(0, len(left_frame), 3):
-                    r, g, b = left_frame[i], left_frame[i + 1], left_frame[i + 2]
-                    f.write(struct.pack('I', (r << 16) | (g << 8) | b))
-                for i in range(0, len(right_frame), 3):
-                    r, g, b = right_frame[i], right_frame[i + 1], right_frame[i + 2]
-                    f.write(struct.pack('I', (r << 16) | (g << 8) | b))
+        return self._write_show_file(output_filename, (
+            _encode_pixels(left_frame) + _encode_pixels(right_frame)
+            for left_frame, right_frame in zip(self.left_frames, self.right_frames)
+        ))
 
-        return output_path
+    def stream_to_file(self, output_filename: str, batches: Iterable[FSEQFrameMatrix]) -> Path:
+        # encodes and writes each batch as it arrives instead of buffering every frame with add_frame
+        def encode_batches() -> Iterable[bytes]:
+            for batch in batches:
+                if batch.light_strip_l.shape[1] != self.bytes_left:
+                    raise ValueError(f'Left frames must have exactly {self.bytes_left} bytes.')
+                if batch.light_strip_r.shape[1] != self.bytes_right:
+                    raise ValueError(f'Right frames must have exactly {self.bytes_right} bytes.')
 
+                yield _encode_pixels(np.hstack((batch.light_strip_l, batch.light_strip_r)))
 
-def generate_show_file(song: Song) -> Path:
-    print_progress(f'Generating show file for "{song.title}"...')
+        return self._write_show_file(output_filename, encode_batches())
+
+
+def _compile_show_file(song: Song, streaming: bool = True) -> Path:
     # parse the song file using FSEQParser and create a _ShowFileGenerator
     parser = FSEQParser(song.fseq_file)
     show_generator = _ShowFileGenerator(
@@ -56,18 +93,123 @@ def generate_show_file(song: Song) -> Path:
         parser.step_time_in_ms
     )
 
-    # iterate over frames of the song, adding to the _ShowFileGenerator each time
-    for frame in parser.iter_frames():
-        show_generator.add_frame(frame.light_strip_l_bytes, frame.light_strip_r_bytes)
+    if streaming:
+        # write batches of frames to disk as they are decompressed
+        show_file = show_generator.stream_to_file(song.title, parser.iter_frame_matrices())
+    else:
+        # iterate over frames of the song, adding to the _ShowFileGenerator each time, then write the show file
+        for frame in parser.iter_frames():
+            show_generator.add_frame(frame.light_strip_l_bytes, frame.light_strip_r_bytes)
+        show_file = show_generator.write_to_file(song.title)
 
-    # write the show file to disk and return the Path object of the file
-    print_done()
-    return show_generator.write_to_file(song.title)
+    # return the Path object of the file written to disk
+    return show_file
 
 
-def generate_all_show_files() -> list[Path]:
-    return [generate_show_file(song) for song in SongScanner(VIXEN_DIR).scan().values()]
+def generate_show_file(song: Song, streaming: bool = True) -> Path:
+    print_progress(f'Generating show file for "{song.title}"...')
+    show_file = _compile_show_file(song, streaming)
+    print_done()
+    return show_file
+
+
+class _ShowManifest:
+    # maps each song title to the fseq file its show was compiled from and the resulting show file
+    # (hidden, so the rsync in zero_commands.txt skips it)
+    PATH = Path('shows/.manifest.json')
+
+    def __init__(self):
+        try:
+            self.entries: dict[str, dict] = json.loads(self.PATH.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.entries = {}
+        self.hashes: dict[str, str] = {}  # fseq hashes computed during this run
+
+    def _fseq_sha256(self, song: Song) -> str:
+        if song.title not in self.hashes:
+            self.hashes[song.title] = file_sha256(song.fseq_file)
+        return self.hashes[song.title]
+
+    def is_up_to_date(self, song: Song) -> bool:
+        entry = self.entries.get(song.title)
+        if entry is None or not Path(entry['show_file']).exists():
+            return False
+
+        stat = song.fseq_file.stat()
+        if stat.st_size != entry['fseq_size']:
+            return False
+        if stat.st_mtime_ns == entry['fseq_mtime_ns']:
+            return True
+
+        # the file was touched (e.g. re-exported by Vixen), only its contents decide if a rebuild is needed
+        if self._fseq_sha256(song) != entry['fseq_sha256']:
+            return False
+        entry['fseq_mtime_ns'] = stat.st_mtime_ns
+        return True
+
+    def record(self, song: Song, show_file: Path) -> None:
+        stat = song.fseq_file.stat()
+        self.entries[song.title] = {
+            'fseq_size': stat.st_size,
+            'fseq_mtime_ns': stat.st_mtime_ns,
+            'fseq_sha256': self._fseq_sha256(song),
+            'show_file': str(show_file)
+        }
+
+    def save(self) -> None:
+        temp_path = self.PATH.with_name(self.PATH.name + '.tmp')
+        temp_path.write_text(json.dumps(self.entries, indent=4))
+        temp_path.replace(self.PATH)
+
+
+def generate_all_show_files(workers: int | None = None, force: bool = False) -> list[Path]:
+    # only songs whose fseq file changed since the last compilation are compiled, unless force is set
+    # returns the paths of the show files that were (re)generated
+    # workers=None uses one process per CPU, workers=1 compiles serially in this process
+    # the workers are spawned, and a spawned process imports the main module of its parent again, so from a process
+    # whose main module does more than import (like api.py, which builds the controller) use
+    # generate_all_show_files_in_subprocess instead
+    manifest = _ShowManifest()
+    songs = [
+        song for song in SongScanner(VIXEN_DIR).scan().values()
+        if force or not manifest.is_up_to_date(song)
+    ]
+
+    if workers == 1:
+        show_files = {song.title: generate_show_file(song) for song in songs}
+        return _record_show_files(manifest, songs, show_files)
+
+    # parsing and packing is CPU-bound, so compile the songs in separate processes
+    # (spawned, not forked: the server process has many threads, and a forked child could inherit a held lock)
+    show_files: dict[str, Path] = {}
+    if songs:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = {executor.submit(_compile_show_file, song): song for song in songs}
+            for i, future in enumerate(as_completed(futures), 1):
+                song = futures[future]
+                show_files[song.title] = future.result()
+                print(f'Generated show file for "{song.title}" ({i}/{len(songs)})')
+
+    return _record_show_files(manifest, songs, show_files)
+
+
+def _record_show_files(manifest: _ShowManifest, songs: list[Song], show_files: dict[str, Path]) -> list[Path]:
+    for song in songs:
+        manifest.record(song, show_files[song.title])
+    manifest.save()
+
+    # return the paths in catalog order, regardless of which song finished first
+    return [show_files[song.title] for song in songs]
+
+
+def generate_all_show_files_in_subprocess(force: bool = False) -> None:
+    # runs generate_all_show_files in a new python process with this file as its main module, so its workers import
+    # nothing but the compiler
+    command = [sys.executable, str(Path(__file__).absolute())]
+    if force:
+        command.append('--force')
+    subprocess.run(command, check=True)
 
 
 if __name__ == '__main__':
-    generate_all_show_files()
+    generate_all_show_files(force='--force' in sys.argv[1:])
@@ -1,31 +1,109 @@
-import base64
 import json
 import re
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import mutagen.mp3
 
-from common import Song, VIXEN_DIR
+from common import Song, VIXEN_DIR, file_sha256
+
+MP3_FILENAME_PATTERN = re.compile(r'\b[\w\-(). ]+\.mp3\b', re.IGNORECASE)
+
+
+def _song_to_json(song: Song) -> dict:
+    return {
+        'title': song.title,
+        'tim_file': str(song.tim_file),
+        'mp3_file': str(song.mp3_file),
+        'fseq_file': str(song.fseq_file),
+        'artist': song.artist,
+        'album_art_file': str(song.album_art_file) if song.album_art_file else None,
+        'album_art_hash': song.album_art_hash,
+        'length_ms': song.length_ms
+    }
+
+
+def _song_from_json(data: dict) -> Song:
+    return Song(
+        title=data['title'],
+        tim_file=Path(data['tim_file']),
+        mp3_file=Path(data['mp3_file']),
+        fseq_file=Path(data['fseq_file']),
+        artist=data['artist'],
+        album_art_file=Path(data['album_art_file']) if data['album_art_file'] else None,
+        album_art_hash=data['album_art_hash'],
+        length_ms=data['length_ms']
+    )
 
 
 class SongScanner:
+    # results of previous scans per .tim file, together with the mtimes of every file the result depends on
+    CACHE_PATH = Path('config/song_scan_cache.json')
+    # scanning is mostly file I/O (large XML, album art, mp3 headers), so threads overlap well
+    SCAN_WORKERS = 8
+    # .tim files are searched this many characters at a time, overlapping by more than any file name is long
+    TIM_CHUNK_SIZE = 1 << 20
+    TIM_CHUNK_OVERLAP = 4096
+
     def __init__(self, vixen_dir: Path):
         self.vixen_dir = vixen_dir
         assert self.vixen_dir.exists()
         assert self.vixen_dir.name == 'Vixen 3'
 
-    def _create_song(self, tim_file: Path) -> Song | None:
+        self.song_info_path = Path('song_info')
+
+    @classmethod
+    def _find_mp3_filename(cls, tim_file: Path) -> str | None:
+        # discover name of mp3 file using .tim file, reading it in chunks and stopping at the first mp3 reference
+        # (the media element), so large sequences are never loaded whole
+        tail = ''
+        with tim_file.open('r') as f:
+            while True:
+                chunk = f.read(cls.TIM_CHUNK_SIZE)
+                text = tail + chunk
+
+                # cheap substring test first, the regex only runs once a chunk mentions an mp3
+                if '.mp3' in text.lower() and (match := MP3_FILENAME_PATTERN.search(text)):
+                    # a match touching the end of the text could still continue in the next chunk
+                    if match.end() < len(text) or not chunk:
+                        return match.group(0)
+                if not chunk:
+                    return None
+
+                # keep the end of this chunk, a file name may be split across two chunks
+                tail = text[-cls.TIM_CHUNK_OVERLAP:]
+
+    def _dependencies(self, tim_file: Path, mp3_filename: str | None) -> list[Path]:
+        # every file whose existence or contents can change the result of _create_song
+        title = tim_file.stem
+        dependencies = [
+            tim_file,
+            self.vixen_dir / 'Export' / (title + '.fseq'),
+            (self.song_info_path / title).with_suffix('.exclude'),
+            self.song_info_path / 'song_info.json',
+            (self.song_info_path / title).with_suffix('.jpg')
+        ]
+        if mp3_filename is not None:
+            dependencies.append(self.vixen_dir / 'Media' / mp3_filename)
+        return dependencies
+
+    @staticmethod
+    def _mtimes(paths: list[Path]) -> dict[str, int | None]:
+        mtimes = {}
+        for path in paths:
+            try:
+                mtimes[str(path)] = path.stat().st_mtime_ns
+            except FileNotFoundError:
+                mtimes[str(path)] = None
+        return mtimes
+
+    def _create_song(self, tim_file: Path, mp3_filename: str | None, song_info: dict) -> Song | None:
         fseq_dir = self.vixen_dir / 'Export'
         mp3_dir = self.vixen_dir / 'Media'
 
-        # first, discover name of mp3 file using .tim file
-        xml_contents = tim_file.read_text()
-        match = re.search(r'\b[\w\-(). ]+\.mp3\b', xml_contents, re.IGNORECASE)
-
         # if there is no song, then skip it (test sequence)
-        if not match:
+        if mp3_filename is None:
             return None
-        mp3_filename = match.group(0)
 
         # next, make sure the mp3 file and fseq file actually exist
         if not (mp3_file := mp3_dir / mp3_filename).exists():
@@ -34,7 +112,7 @@ class SongScanner:
             return None
 
         # get song info path for extracting metadata and image
-        song_info_path = Path('song_info')
+        song_info_path = self.song_info_path
         title = tim_file.stem
 
         # if the song is marked as exclude, don't create a Song object
@@ -42,18 +120,19 @@ class SongScanner:
             return None
 
         # get artist and other metadata if available
-        song_info_json = json.loads((song_info_path / 'song_info.json').read_text())
-        if metadata := song_info_json.get(title):
+        if metadata := song_info.get(title):
             artist = metadata.get('artist') or 'Unknown Artist'
         else:
             artist = 'Unknown Artist'
 
-        # get album art if available
+        # get album art if available, only its hash travels with the song, the image is served separately
         image_file = (song_info_path / title).with_suffix('.jpg')
         if image_file.exists():
-            album_art = base64.b64encode(image_file.read_bytes()).decode('utf-8')
+            album_art_file = image_file
+            album_art_hash = file_sha256(image_file)
         else:
-            album_art = ''
+            album_art_file = None
+            album_art_hash = ''
 
         # get length of the song
         length = mutagen.mp3.MP3(mp3_file).info.length * 1000
@@ -65,16 +144,61 @@ class SongScanner:
             mp3_file=mp3_file,
             fseq_file=fseq_file,
             artist=artist,
-            album_art=album_art,
+            album_art_file=album_art_file,
+            album_art_hash=album_art_hash,
             length_ms=length
         )
 
-    def scan(self) -> dict[str, Song]:
+    def _scan_tim_file(self, tim_file: Path, cached: dict | None, song_info: dict) -> dict:
+        # reuse the cached result as long as none of the files it was created from changed
+        if cached is not None and self._mtimes([Path(path) for path in cached['mtimes']]) == cached['mtimes']:
+            return cached
+
+        mp3_filename = self._find_mp3_filename(tim_file)
+        mtimes = self._mtimes(self._dependencies(tim_file, mp3_filename))
+        song = self._create_song(tim_file, mp3_filename, song_info)
+        return {
+            'mtimes': mtimes,
+            'song': _song_to_json(song) if song else None
+        }
+
+    def _load_song_info(self) -> dict:
+        try:
+            return json.loads((self.song_info_path / 'song_info.json').read_text())
+        except FileNotFoundError:
+            return {}
+
+    def _load_cache(self) -> dict[str, dict]:
+        try:
+            return json.loads(self.CACHE_PATH.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _save_cache(self, cache: dict[str, dict]) -> None:
+        temp_path = self.CACHE_PATH.with_name(self.CACHE_PATH.name + '.tmp')
+        temp_path.write_text(json.dumps(cache, indent=4))
+        temp_path.replace(self.CACHE_PATH)
+
+    def scan(self, use_cache: bool = True, workers: int = SCAN_WORKERS) -> dict[str, Song]:
         seq_dir = self.vixen_dir / 'Sequence'
+        tim_files = sorted(seq_dir.glob('[!.]*.tim'))
+        song_info = self._load_song_info()
+
+        # only new or changed sequences are examined again, the cache is rewritten with the current results
+        # (executor.map keeps the results in the order of tim_files, no matter which thread finishes first)
+        cache = self._load_cache() if use_cache else {}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            entries = executor.map(
+                lambda tim_file: self._scan_tim_file(tim_file, cache.get(str(tim_file)), song_info),
+                tim_files
+            )
+            cache = dict(zip(map(str, tim_files), entries))
+        self._save_cache(cache)
+
         # use walrus operator to create flatmap within dict comprehension
         return {
-            song.title: song for tim_file in seq_dir.glob('[!.]*.tim')
-            if (song := self._create_song(tim_file))
+            song.title: song for entry in cache.values()
+            if entry['song'] and (song := _song_from_json(entry['song']))
         }
 
 
@@ -1,11 +1,23 @@
+import atexit
+import json
 import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from enum import StrEnum
 from pathlib import Path
+from threading import local, Lock, Thread
 
 from fabric import Connection
 from humanize import naturalsize
+from paramiko import SFTPClient, SSHException
 
-from common import ZERO_IP, ZERO_PORT
+from common import ZERO_IP, ZERO_PORT, LED_SERVER_STUB, file_sha256
+
+REMOTE_SHOWS_DIR = '/home/pylightszero/shows'
+# size and checksum of every show uploaded by upload_shows, so unchanged shows are not sent again
+REMOTE_MANIFEST_PATH = f'{REMOTE_SHOWS_DIR}/.upload_manifest.json'
 
 
 class _ZeroClient(Connection):
@@ -14,59 +26,445 @@ class _ZeroClient(Connection):
         super().__init__(
             host=ZERO_IP,
             user='pylightszero',
+            connect_timeout=5,
             connect_kwargs={'key_filename': str(ssh_key_file)}
         )
 
 
+class _ZeroClientPool:
+    # one SSH session to the zero, opened on first use and shared by every operation, so only the first one pays
+    # for the handshake; a session that stopped working (e.g. the zero rebooted) is replaced by a new one
+    # a session used within this many seconds is trusted without checking it again
+    HEALTH_CHECK_INTERVAL_S = 5.0
+    HEALTH_CHECK_TIMEOUT_S = 2.0
+    KEEPALIVE_INTERVAL_S = 15
+
+    def __init__(self):
+        self.lock = Lock()
+        self.client: _ZeroClient | None = None
+        self.last_healthy = 0.0
+
+    def _healthy(self) -> bool:
+        if self.client is None or not self.client.is_connected:
+            return False
+        if time.perf_counter() - self.last_healthy < self.HEALTH_CHECK_INTERVAL_S:
+            return True
+
+        # opening a channel needs a round trip, unlike transport.active which stays set until a write fails
+        try:
+            self.client.transport.open_session(timeout=self.HEALTH_CHECK_TIMEOUT_S).close()
+        except (SSHException, OSError, EOFError):
+            return False
+        return True
+
+    def get(self) -> _ZeroClient:
+        with self.lock:
+            if not self._healthy():
+                self._discard()
+                client = _ZeroClient()
+                client.open()
+                client.transport.set_keepalive(self.KEEPALIVE_INTERVAL_S)
+                self.client = client
+            self.last_healthy = time.perf_counter()
+            return self.client
+
+    def _discard(self) -> None:
+        if self.client is not None:
+            try:
+                self.client.close()
+            except (SSHException, OSError, EOFError):
+                pass
+            self.client = None
+
+    def invalidate(self) -> None:
+        # called after an operation failed on the session, the next get() connects again
+        with self.lock:
+            self._discard()
+
+    def run(self, command: str, **kwargs):
+        # a session can die between the health check and the command, so a failed command gets one fresh session
+        try:
+            return self.get().run(command, **kwargs)
+        except (SSHException, OSError, EOFError):
+            self.invalidate()
+            return self.get().run(command, **kwargs)
+
+    def close(self) -> None:
+        with self.lock:
+            self._discard()
+
+
+_zero_client_pool = _ZeroClientPool()
+atexit.register(_zero_client_pool.close)
+
+
 class LEDServerCommand(StrEnum):
     PLAY = 'PLAY'
     PAUSE = 'PAUSE'
     RESUME = 'RESUME'
     STOP = 'STOP'
+    PING = 'PING'
+    SYNC = 'SYNC'
+    QUEUE = 'QUEUE'
+    NEXT = 'NEXT'
+
+
+class _LEDServerChannel:
+    # one long-lived control connection to led_server, reconnected on demand when it drops
+    # protocol: every command is one line ('PLAY\n'), led_server answers each one with 'ACK <command>\n',
+    # so commands can be pipelined and the time until the last acknowledgement is the real command latency;
+    # once its show is loaded, led_server also sends 'READY <show file name>\n' to every client
+    CONNECT_TIMEOUT_S = 1.0
+    ACK_TIMEOUT_S = 1.0
+    # an idle connection is pinged this often, so a dead led_server is noticed before the next real command
+    KEEPALIVE_INTERVAL_S = 2.0
+    # while led_server is starting up, connecting is retried this often
+    RECONNECT_INTERVAL_S = 0.05
+    # a led_server that does not acknowledge the first PING on a connection within this time (or hangs up instead)
+    # is an older build without this protocol: one bare command per connection, no ACK and no READY
+    PROTOCOL_PROBE_TIMEOUT_S = 0.5
+    # such a led_server cannot say when its show is loaded, so it gets the fixed time play() used to sleep
+    LEGACY_LOAD_TIME_S = 1.0
+    LEGACY_COMMANDS = ('PLAY', 'PAUSE', 'RESUME', 'STOP')
+
+    def __init__(self, host: str, port: int):
+        self.address = (host, port)
+        self.lock = Lock()
+        self.sock: socket.socket | None = None
+        self.buffer = b''
+        self.last_used = 0.0
+        self.last_rtt_ms: float | None = None
+        self.ready_show: str | None = None  # show led_server announced as loaded on this connection
+        self.legacy: bool | None = None  # whether led_server is an older build, found out on the first connection
+        self.keepalive_thread: Thread | None = None
+
+    @property
+    def connected(self) -> bool:
+        return self.sock is not None
+
+    def _connect(self) -> None:
+        sock = socket.create_connection(self.address, timeout=self.CONNECT_TIMEOUT_S)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(self.ACK_TIMEOUT_S)
+        self.sock = sock
+        self.buffer = b''
+        self.ready_show = None
+
+        if self.legacy is None:
+            self._probe_protocol()
+        if self.legacy:
+            self._disconnect()
+            return
+
+        if self.keepalive_thread is None:
+            self.keepalive_thread = Thread(target=self._keepalive_loop, daemon=True)
+            self.keepalive_thread.start()
+
+    def _probe_protocol(self) -> None:
+        self.sock.settimeout(self.PROTOCOL_PROBE_TIMEOUT_S)
+        try:
+            self.sock.sendall(f'{LEDServerCommand.PING}\n'.encode())
+            self._read_ack(LEDServerCommand.PING)
+            self.legacy = False
+        except (TimeoutError, ConnectionResetError):
+            self.legacy = True
+            print('led_server does not acknowledge commands, falling back to its old protocol')
+        self.sock.settimeout(self.ACK_TIMEOUT_S)
+
+    def _legacy_exchange(self, commands: list[list[str]]) -> tuple[list[list[str]], None]:
+        # one connection per command, carrying only the bare command name; PING just checks that it connects
+        for words in commands:
+            with socket.create_connection(self.address, timeout=self.CONNECT_TIMEOUT_S) as sock:
+                if words[0] in self.LEGACY_COMMANDS:
+                    sock.sendall(words[0].encode())
+        self.last_used = time.perf_counter()
+        self.last_rtt_ms = None
+        return [[] for _ in commands], None
+
+    def _disconnect(self) -> None:
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            self.ready_show = None
+
+    def close(self) -> None:
+        with self.lock:
+            self._disconnect()
+
+    def reset(self) -> None:
+        # for a newly started led_server, which may be a different build than the previous one
+        with self.lock:
+            self._disconnect()
+            self.legacy = None
+
+    def _read_line(self) -> str:
+        while b'\n' not in self.buffer:
+            if not (data := self.sock.recv(4096)):
+                raise ConnectionResetError('led_server closed the connection')
+            self.buffer += data
+        line, self.buffer = self.buffer.split(b'\n', 1)
+        return line.decode()
+
+    def _handle_message(self, line: str) -> None:
+        if line.startswith('READY '):
+            self.ready_show = line.removeprefix('READY ')
+
+    def _read_ack(self, command: str) -> list[str]:
+        # acknowledgements arrive in command order, anything else led_server says in between is handled aside
+        while True:
+            line = self._read_line()
+            words = line.split()
+            if words[:2] == ['ACK', command]:
+                return words[2:]
+            self._handle_message(line)
+
+    def _exchange(self, commands: list[list[str]]) -> tuple[list[list[str]], float | None]:
+        # returns the values led_server put in each acknowledgement, and the round trip time in ms
+        # (None for an older led_server, which acknowledges nothing)
+        if self.legacy:
+            return self._legacy_exchange(commands)
+        payload = ''.join(' '.join(words) + '\n' for words in commands).encode()
+
+        # a connection that was already open may have gone stale (led_server restarted), in that case it is
+        # reconnected and the commands sent once more; a fresh connection that fails, or a timeout, is an error
+        for retry in (True, False):
+            reused = self.sock is not None
+            try:
+                if not reused:
+                    self._connect()
+                    if self.legacy:
+                        return self._legacy_exchange(commands)
+                start = time.perf_counter()
+                self.sock.sendall(payload)
+                values = [self._read_ack(words[0]) for words in commands]
+                rtt_ms = (time.perf_counter() - start) * 1000
+                break
+            except OSError as e:
+                self._disconnect()
+                if not (retry and reused) or isinstance(e, TimeoutError):
+                    raise
+
+        self.last_used = time.perf_counter()
+        self.last_rtt_ms = rtt_ms
+        return values, rtt_ms
+
+    def request(self, command: str, *args) -> tuple[list[str], float | None]:
+        # returns the values in led_server's acknowledgement and the round trip time until it arrived, in ms
+        with self.lock:
+            values, rtt_ms = self._exchange([[command, *map(str, args)]])
+            return values[0], rtt_ms
 
+    def send(self, command: str, *args) -> float | None:
+        # returns the round trip time until led_server acknowledged the command, in ms
+        return self.request(command, *args)[1]
 
-def _upload_show(zc: _ZeroClient, show_file: Path, current: int, total: int):
-    file_size = show_file.stat().st_size
-    print(f'Uploading show "{show_file.stem}" of size {naturalsize(file_size)}...', end='', flush=True)
-    zc.put(show_file, '/home/pylightszero/shows')
-    print(f'Done ({current}/{total})')
+    def send_commands(self, commands: list[list[str]]) -> float | None:
+        # pipelined: all commands are written at once, then all acknowledgements are collected
+        with self.lock:
+            return self._exchange(commands)[1]
 
+    def wait_ready(self, show_name: str, timeout_s: float) -> bool:
+        # block until led_server announced that it loaded the given show, connecting as soon as it listens
+        start = time.perf_counter()
+        deadline = start + timeout_s
+        with self.lock:
+            while self.ready_show != show_name:
+                if (remaining := deadline - time.perf_counter()) <= 0:
+                    return False
+                try:
+                    if self.sock is None:
+                        self._connect()
+                    if self.legacy:
+                        # an older led_server never says READY, so give it the time play() used to sleep
+                        time.sleep(max(0.0, start + self.LEGACY_LOAD_TIME_S - time.perf_counter()))
+                        return True
+                    self.sock.settimeout(remaining)
+                    self._handle_message(self._read_line())
+                    self.sock.settimeout(self.ACK_TIMEOUT_S)
+                except TimeoutError:
+                    self._disconnect()
+                    return False
+                except OSError:
+                    # led_server is not listening yet, or this was the connection to the previous one
+                    self._disconnect()
+                    time.sleep(min(self.RECONNECT_INTERVAL_S, remaining))
+            self.last_used = time.perf_counter()
+            return True
+
+    def _keepalive_loop(self) -> None:
+        while True:
+            time.sleep(self.KEEPALIVE_INTERVAL_S)
+            with self.lock:
+                idle = time.perf_counter() - self.last_used >= self.KEEPALIVE_INTERVAL_S
+                if self.sock is None or not idle:
+                    continue
+                try:
+                    self._exchange([[LEDServerCommand.PING]])
+                except OSError:
+                    pass  # already disconnected, the next command reconnects
+
+
+_led_server_channel = _LEDServerChannel(ZERO_IP, ZERO_PORT)
+
+
+def _upload_show(sftp: SFTPClient, show_file: Path) -> int:
+    sftp.put(str(show_file), f'{REMOTE_SHOWS_DIR}/{show_file.name}')
+    return show_file.stat().st_size
+
+
+def _read_remote_manifest(sftp: SFTPClient) -> dict[str, dict]:
+    try:
+        with sftp.open(REMOTE_MANIFEST_PATH, 'r') as f:
+            return json.loads(f.read())
+    except (IOError, json.JSONDecodeError):
+        return {}
+
+
+def upload_shows(show_files: list[Path], delta: bool = True, workers: int = 4) -> None:
+    if not show_files:
+        return
+
+    zc = _zero_client_pool.get()
+    try:
+        sftp = zc.sftp()
+
+        # with delta, only send shows whose size or checksum differs from what the zero already has
+        local_manifest = {
+            show_file.name: {'size': show_file.stat().st_size, 'sha256': file_sha256(show_file)}
+            for show_file in show_files
+        }
+        remote_manifest = _read_remote_manifest(sftp)
+        if delta:
+            remote_sizes = {attr.filename: attr.st_size for attr in sftp.listdir_attr(REMOTE_SHOWS_DIR)}
+            show_files = [
+                show_file for show_file in show_files
+                if remote_manifest.get(show_file.name) != local_manifest[show_file.name]
+                or remote_sizes.get(show_file.name) != local_manifest[show_file.name]['size']
+            ]
+            print(f'{len(local_manifest) - len(show_files)} show(s) already up to date on pylightszero')
+
+        # run the transfers in parallel, each thread on its own SFTP channel over the one SSH connection
+        thread_channels = local()
+        channels: list[SFTPClient] = []
+        channels_lock = Lock()
+
+        def upload(show_file: Path) -> int:
+            if not hasattr(thread_channels, 'sftp'):
+                thread_channels.sftp = zc.client.open_sftp()
+                with channels_lock:
+                    channels.append(thread_channels.sftp)
+            return _upload_show(thread_channels.sftp, show_file)
+
+        start = time.perf_counter()
+        total_bytes = 0
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(upload, show_file): show_file for show_file in show_files}
+                for i, future in enumerate(as_completed(futures), 1):
+                    file_size = future.result()
+                    total_bytes += file_size
+                    print(f'Uploaded show "{futures[future].stem}" of size {naturalsize(file_size)} '
+                          f'({i}/{len(show_files)})')
+        finally:
+            for channel in channels:
+                channel.close()
+        elapsed = time.perf_counter() - start
 
-def upload_shows(show_files: list[Path]) -> None:
-    with _ZeroClient() as zc:
-        for i, show_file in enumerate(show_files, 1):
-            _upload_show(zc, show_file, i, len(show_files))
+        # record what the zero now has
+        remote_manifest.update({show_file.name: local_manifest[show_file.name] for show_file in show_files})
+        with sftp.open(REMOTE_MANIFEST_PATH, 'w') as f:
+            f.write(json.dumps(remote_manifest, indent=4))
+    except (SSHException, EOFError, ConnectionError):
+        _zero_client_pool.invalidate()
+        raise
+
+    throughput = naturalsize(total_bytes / elapsed) if elapsed > 0 else naturalsize(0)
+    print(f'Uploaded {naturalsize(total_bytes)} in {elapsed:.1f}s ({throughput}/s)')
 
 
 def start_led_server(show_file: Path) -> None:
+    # the control connection belongs to the previous led_server, the new one announces READY on a new connection
+    _led_server_channel.reset()
+
+    if LED_SERVER_STUB:
+        print(f'Starting led_server_stub.py for "{show_file.name}"...', end='', flush=True)
+        stub = Path(__file__).with_name('led_server_stub.py')
+        subprocess.Popen([sys.executable, str(stub), str(show_file)], start_new_session=True)
+        print('Done')
+        return
+
     cmd = f'sudo ./led_server "shows/{show_file.name}" &'
     print(f'Running command: {cmd}...', end='', flush=True)
     if ZERO_IP:  # ZERO_IP = '' when pi zero is offline
-        with _ZeroClient() as zc:
-            zc.run(cmd, disown=True)
+        _zero_client_pool.run(cmd, disown=True)
     print('Done')
 
 
-def send_led_server_command(command: LEDServerCommand) -> None:
+def wait_for_led_server_ready(show_file: Path, timeout_s: float = 10.0) -> bool:
+    if not ZERO_IP:  # ZERO_IP = '' when pi zero is offline
+        return False
+    return _led_server_channel.wait_ready(show_file.name, timeout_s)
+
+
+def send_led_server_command(command: LEDServerCommand, *args) -> float | None:
+    # returns how long led_server took to acknowledge the command, in ms (None if it was not delivered)
+    if not ZERO_IP:  # ZERO_IP = '' when pi zero is offline
+        print(f'Subcommand "{command}" skipped, pylightszero is offline.')
+        return None
+
     try:
-        if ZERO_IP:  # ZERO_IP = '' when pi zero is offline
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.connect((ZERO_IP, ZERO_PORT))
-                s.sendall(command.encode())
-        print(f'Subcommand "{command}" sent successfully.')
-    except ConnectionRefusedError:
+        rtt_ms = _led_server_channel.send(command, *args)
+        if rtt_ms is None:
+            print(f'Subcommand "{command}" sent successfully.')
+        else:
+            print(f'Subcommand "{command}" acknowledged in {rtt_ms:.1f}ms.')
+        return rtt_ms
+    except TimeoutError:
+        print(f'Subcommand "{command}" was not acknowledged by led_server.')
+    except OSError:
         print('Could not connect to led_server. Ensure it is running.')
+    return None
+
+
+def queue_led_server_show(show_file: Path) -> bool:
+    # led_server loads the show in the background while the current one plays and announces READY once it did,
+    # then NEXT switches to it without starting a new led_server
+    # returns whether led_server accepted the show, an older led_server knows no QUEUE
+    if not ZERO_IP or _led_server_channel.legacy:
+        return False
+    with _led_server_channel.lock:
+        _led_server_channel.ready_show = None
+    return send_led_server_command(LEDServerCommand.QUEUE, show_file.name) is not None
+
+
+def sync_led_server(position_ms: float) -> float | None:
+    # tells led_server where the show should be by now, it slews or jumps to match; this happens every second,
+    # so unlike send_led_server_command it prints nothing
+    # returns how far ahead led_server was before correcting, in ms (None if it was not playing or unreachable)
+    if not ZERO_IP or _led_server_channel.legacy:  # ZERO_IP = '' when pi zero is offline
+        return None
+    try:
+        values, _ = _led_server_channel.request(LEDServerCommand.SYNC, round(position_ms))
+    except OSError:
+        return None
+    return float(values[0]) if values else None
 
 
 def check_led_server_running() -> bool:
+    if not ZERO_IP:
+        return False
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((ZERO_IP, ZERO_PORT))
-            return True
-    except ConnectionRefusedError:
+        _led_server_channel.send(LEDServerCommand.PING)
+        return True
+    except OSError:
         return False
 
 
+def led_server_rtt_ms() -> float | None:
+    # round trip time of the most recent acknowledged command or keepalive
+    return _led_server_channel.last_rtt_ms
+
+
 if __name__ == '__main__':
     # upload_shows(list(Path('shows').glob('[!.]*.show')))
     # start_led_server(Path('shows/Carey Grinch.show'))